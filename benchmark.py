@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+
+import argparse
+import platform
+import subprocess
+import json
+import time
+import sys
+import os
+
+from pathlib import Path
+
+import numpy as np
+import hypertiling
+
+from search import AutomatonState, HISTORIES
+from search_many import GEOMETRIES
+from hypergol.automaton import HyperbolicAutomaton
+from hypergol.tiling import load_geometry
+from hypergol.kernels import BACKENDS
+
+# metrics where more is better; all others are durations in seconds
+HIGHER_IS_BETTER = ('generations_per_second', 'cells_per_second')
+
+RULE = 'b 3 s 2 3'
+
+def best_time(function, repeat):
+    """
+    Shortest of repeat timings of function(), the least disturbed by anything else running on the machine.
+    """
+
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+
+    return min(times)
+
+def environment():
+    try:
+        import numba
+        numba_version = numba.__version__
+    except ImportError:
+        numba_version = None
+
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=Path(__file__).parent, capture_output=True, text=True,
+                                check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'numpy': np.__version__,
+        'hypertiling': hypertiling.__version__,
+        'numba': numba_version,
+        'commit': commit,
+    }
+
+def bench_steps(automaton, steps, repeat):
+    """
+    Shortest time of repeat runs of steps generations, each from the same random initial state.
+    """
+
+    # the first step compiles the numba kernels
+    automaton.step()
+
+    times = []
+    for _ in range(repeat):
+        automaton.rng = np.random.default_rng(0)
+        automaton.randomize(0.5)
+
+        start = time.perf_counter()
+        for _ in range(steps):
+            automaton.step()
+        times.append(time.perf_counter() - start)
+
+    return min(times)
+
+def bench_history(automaton, history, steps, repeat):
+    """
+    Seconds per generation that a Search spends on snapshotting a generation and looking it up in and adding it to
+    its history, over the first steps generations of a random automaton.
+    """
+
+    automaton.rng = np.random.default_rng(0)
+    automaton.randomize(0.5)
+    generations = []
+    for _ in range(steps):
+        generations.append((automaton.states.copy(), automaton.population))
+        automaton.step()
+
+    def run():
+        cycles = HISTORIES[history]()
+        for generation, (states, population) in enumerate(generations):
+            automaton_state = AutomatonState(states, automaton.States, population=population)
+            cycles.lookup(automaton_state)
+            cycles.add(automaton_state, generation)
+
+    return best_time(run, repeat) / steps
+
+def bench_shell(automaton, frames, repeat):
+    """
+    Seconds per frame of the shell, redrawing only the cells and redrawing everything.
+    """
+
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    from hypergol.shell import HypergolShell
+
+    shell = HypergolShell(automaton)
+    shell.draw_indices = False
+    shell.draw()
+
+    def frame():
+        for _ in range(frames):
+            automaton.step()
+            shell.publish()
+            shell.draw()
+
+    def redraw():
+        for _ in range(frames):
+            shell.stale = True
+            shell.publish()
+            shell.draw()
+
+    results = {
+        'shell_frame': best_time(frame, repeat) / frames,
+        'shell_redraw': best_time(redraw, repeat) / frames,
+    }
+    plt.close(shell.fig)
+
+    return results
+
+def bench_geometry(p, q, layers, steps=200, repeat=3, backend='auto', shell=True, shell_max_cells=5000, frames=10):
+    """
+    Returns the metrics of the {p, q} tiling with the given number of layers.
+    """
+
+    metrics = {}
+    metrics['tiling_build'] = best_time(lambda: load_geometry(p, q, layers, cache=False), repeat)
+
+    # fill the cache before timing loads from it
+    load_geometry(p, q, layers)
+    metrics['tiling_load'] = best_time(lambda: load_geometry(p, q, layers), repeat)
+
+    automaton = HyperbolicAutomaton(RULE, p, q, layers, backend=backend)
+    cells = len(automaton.geometry)
+
+    automaton.rng = np.random.default_rng(0)
+    metrics['randomize'] = best_time(lambda: automaton.randomize(0.5), repeat)
+
+    seconds = bench_steps(automaton, steps, repeat)
+    metrics['step'] = seconds / steps
+    metrics['generations_per_second'] = steps / seconds
+    metrics['cells_per_second'] = steps * cells / seconds
+
+    for history in HISTORIES:
+        metrics[f'history_{history}'] = bench_history(automaton, history, steps, repeat)
+
+    if shell and cells <= shell_max_cells:
+        metrics.update(bench_shell(automaton, frames, repeat))
+
+    return {'p': p, 'q': q, 'layers': layers, 'cells': cells, 'metrics': metrics}
+
+def compare(results, baseline, tolerance):
+    """
+    Yields (p, q, layers, metric, baseline value, value, change, regressed) for every metric that is in both results
+    and baseline. change is the relative slowdown, positive when worse; a metric regressed if that exceeds tolerance.
+    """
+
+    old = {(entry['p'], entry['q'], entry['layers']): entry['metrics'] for entry in baseline['results']}
+
+    for entry in results['results']:
+        key = (entry['p'], entry['q'], entry['layers'])
+        if key not in old:
+            continue
+
+        for metric, value in entry['metrics'].items():
+            if metric not in old[key]:
+                continue
+
+            before = old[key][metric]
+            if metric in HIGHER_IS_BETTER:
+                change = before / value - 1
+            else:
+                change = value / before - 1
+
+            yield (*key, metric, before, value, change, change > tolerance)
+
+def format_value(metric, value):
+    if metric in HIGHER_IS_BETTER:
+        return f'{value:.4g}/s'
+    return f'{value * 1e3:.4g}ms'
+
+def parse_geometry(geometry_str):
+    try:
+        p, q = map(int, geometry_str.split(','))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'invalid geometry: {geometry_str}')
+    return p, q
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark tiling construction, stepping, cycle detection and drawing')
+    parser.add_argument('-g', '--geometry', help='p,q of a tiling to benchmark. may be given several times. default: the search_many.py geometries',
+                        type=parse_geometry, action='append', metavar='P,Q')
+    parser.add_argument('-l', '--layers', help='layer counts to benchmark. default: 3 5 7', type=int, nargs='+', default=[3, 5, 7])
+    parser.add_argument('-s', '--steps', help='generations per timing. default: 200', type=int, default=200)
+    parser.add_argument('-r', '--repeat', help='number of timings of which the best is kept. default: 3', type=int, default=3)
+    parser.add_argument('-b', '--backend', help='step engine. default: auto (chosen by cell count)', choices=('auto', *BACKENDS), default='auto')
+    parser.add_argument('--no-shell', help='do not benchmark shell frames', dest='shell', action='store_false')
+    parser.add_argument('--shell-max-cells', help='only benchmark shell frames of tilings with at most this many cells. default: 5000',
+                        type=int, default=5000)
+    parser.add_argument('-o', '--output', help='write the results as JSON to this file', type=Path)
+    parser.add_argument('--baseline', help='compare against results written by an earlier run with --output', type=Path)
+    parser.add_argument('-t', '--tolerance', help='relative slowdown against the baseline reported as a regression. default: 0.2',
+                        type=float, default=0.2)
+
+    args = parser.parse_args()
+
+    baseline = None
+    if args.baseline is not None:
+        baseline = json.loads(args.baseline.read_text())
+
+    results = {
+        'environment': environment(),
+        'config': {'steps': args.steps, 'repeat': args.repeat, 'backend': args.backend, 'rule': RULE},
+        'results': [],
+    }
+
+    for p, q in args.geometry or GEOMETRIES:
+        for layers in args.layers:
+            entry = bench_geometry(p, q, layers, steps=args.steps, repeat=args.repeat, backend=args.backend, shell=args.shell,
+                                   shell_max_cells=args.shell_max_cells)
+            results['results'].append(entry)
+
+            metrics = ' '.join(f'{metric}={format_value(metric, value)}' for metric, value in entry['metrics'].items())
+            print(f'{p}_{q} layers={layers} cells={entry["cells"]} {metrics}', flush=True)
+
+    if args.output is not None:
+        args.output.write_text(json.dumps(results, indent=2) + '\n')
+
+    if baseline is None:
+        return
+
+    for name, value in baseline['environment'].items():
+        if results['environment'].get(name) != value and name != 'commit':
+            print(f'warning: baseline {name} was {value}, now {results["environment"].get(name)}')
+
+    regressions = 0
+    for p, q, layers, metric, before, value, change, regressed in compare(results, baseline, args.tolerance):
+        regressions += regressed
+        print(f'{p}_{q} layers={layers} {metric}: {format_value(metric, before)} -> {format_value(metric, value)} '
+              f'({change:+.1%}){" REGRESSION" if regressed else ""}')
+
+    if regressions:
+        print(f'{regressions} regressions beyond {args.tolerance:.0%}')
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+
+import sqlite3
+import pickle
+import json
+
+from pathlib import Path
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS state (
+    key TEXT PRIMARY KEY,
+    value BLOB NOT NULL
+);
+CREATE TABLE IF NOT EXISTS batches (
+    id INTEGER PRIMARY KEY,
+    configs TEXT NOT NULL,
+    status TEXT NOT NULL,
+    checkpoint BLOB
+);
+CREATE TABLE IF NOT EXISTS runs (
+    p INTEGER NOT NULL,
+    q INTEGER NOT NULL,
+    layers INTEGER NOT NULL,
+    rule TEXT NOT NULL,
+    seed TEXT NOT NULL,
+    batch INTEGER NOT NULL REFERENCES batches (id),
+    PRIMARY KEY (p, q, layers, rule, seed)
+);
+'''
+
+class Campaign():
+    """
+    Manifest of a search_many.py campaign, stored in an SQLite database. It records every batch of configs the
+    campaign generated, whether the batch is pending, running, failed or done, the latest checkpoint of running batches
+    and the state of the random generator that draws the configs, so that a stopped campaign can resume where it
+    left off without running any (geometry, layers, rule, seed) twice.
+    """
+
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.connection = sqlite3.connect(self.path, timeout=60)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.executescript(SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.connection.close()
+
+    def random_state(self):
+        """
+        State of the config generator's random module and SeedSequence after the last added batch, or None for a new
+        campaign.
+        """
+
+        row = self.connection.execute("SELECT value FROM state WHERE key = 'random'").fetchone()
+        return None if row is None else pickle.loads(row[0])
+
+    def tried(self, p, q, layers, rule):
+        """
+        Whether rule was already part of this campaign on the {p, q} tiling with the given number of layers.
+        """
+
+        row = self.connection.execute('SELECT 1 FROM runs WHERE p = ? AND q = ? AND layers = ? AND rule = ? LIMIT 1',
+                                      (p, q, layers, rule)).fetchone()
+        return row is not None
+
+    def add(self, configs, random_state):
+        """
+        Records a pending batch together with the random state it was drawn with. Returns the id of the batch.
+        """
+
+        with self.connection:
+            cursor = self.connection.execute('INSERT INTO batches (configs, status) VALUES (?, ?)',
+                                             (json.dumps(configs), self.PENDING))
+            batch_id = cursor.lastrowid
+
+            self.connection.executemany('INSERT INTO runs (p, q, layers, rule, seed, batch) VALUES (?, ?, ?, ?, ?, ?)',
+                                        [(p, q, layers, rule, str(seed), batch_id) for rule, p, q, layers, seed, _, _ in configs])
+            self.connection.execute("INSERT OR REPLACE INTO state (key, value) VALUES ('random', ?)",
+                                    (pickle.dumps(random_state),))
+
+        return batch_id
+
+    def unfinished(self):
+        """
+        Returns (id, configs) of every batch that was not done when the campaign stopped.
+        """
+
+        rows = self.connection.execute('SELECT id, configs FROM batches WHERE status != ? ORDER BY id', (self.DONE,))
+        return [(batch_id, [tuple(config) for config in json.loads(configs)]) for batch_id, configs in rows]
+
+    def start(self, batch_id):
+        """
+        Marks a batch as running and returns its latest checkpoint, or None.
+        """
+
+        with self.connection:
+            self.connection.execute('UPDATE batches SET status = ? WHERE id = ?', (self.RUNNING, batch_id))
+            row = self.connection.execute('SELECT checkpoint FROM batches WHERE id = ?', (batch_id,)).fetchone()
+
+        return None if row[0] is None else pickle.loads(row[0])
+
+    def checkpoint(self, batch_id, checkpoint):
+        with self.connection:
+            self.connection.execute('UPDATE batches SET checkpoint = ? WHERE id = ?', (pickle.dumps(checkpoint), batch_id))
+
+    def fail(self, batch_id):
+        """
+        Marks a batch as failed. Its checkpoint may be what made it fail, so a resumed campaign runs it from the start.
+        """
+
+        with self.connection:
+            self.connection.execute('UPDATE batches SET status = ?, checkpoint = NULL WHERE id = ?', (self.FAILED, batch_id))
+
+    def finish(self, batch_id):
+        with self.connection:
+            self.connection.execute('UPDATE batches SET status = ?, checkpoint = NULL WHERE id = ?', (self.DONE, batch_id))
+
+    def counts(self):
+        """
+        Returns the number of batches by status.
+        """
+
+        return dict(self.connection.execute('SELECT status, COUNT(*) FROM batches GROUP BY status'))
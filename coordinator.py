@@ -0,0 +1,452 @@
+#!/usr/bin/env python3
+
+import argparse
+import collections
+import multiprocessing
+import socketserver
+import threading
+import traceback
+import signal
+import socket
+import json
+import time
+import sys
+import os
+
+from pathlib import Path
+
+from search_many import GEOMETRIES, WarmAutomata, config_generator, campaign_batches, run_search, add_search_arguments, check_search_arguments
+from results import ResultStore
+from campaign import Campaign
+from hypergol.tiling import load_geometry
+
+# seconds a worker may hold a batch without renewing its lease before the batch is handed to another worker
+DEFAULT_LEASE = 60
+
+# seconds a worker waits before asking again when every batch is leased
+RETRY_WAIT = 1
+
+# seconds a finished coordinator keeps telling polling workers that it is done
+LINGER = 3
+
+# requests are a single line of JSON, answered by a single line of JSON
+TIMEOUT = 30
+
+def parse_address(address):
+    """
+    Returns (family, address) for HOST:PORT, or for the path of a Unix socket if address contains a slash.
+    """
+
+    if '/' in address:
+        return socket.AF_UNIX, address
+
+    host, sep, port = address.rpartition(':')
+    if not sep or not port.isdigit():
+        raise RuntimeError(f'invalid address: {address}. format: HOST:PORT or the path of a Unix socket')
+
+    return socket.AF_INET, (host or 'localhost', int(port))
+
+def request(address, message):
+    """
+    Sends message to the coordinator at address and returns its reply.
+    """
+
+    family, address = parse_address(address)
+
+    with socket.socket(family, socket.SOCK_STREAM) as sock:
+        sock.settimeout(TIMEOUT)
+        sock.connect(address)
+        with sock.makefile('rwb') as stream:
+            stream.write(json.dumps(message).encode() + b'\n')
+            stream.flush()
+            line = stream.readline()
+
+    if not line:
+        raise ConnectionError('the coordinator closed the connection')
+
+    return json.loads(line)
+
+class Coordinator():
+    """
+    Hands out batches of configs to workers and stores the results they send back. Each batch is leased to one worker
+    at a time. If that worker neither renews the lease nor returns results before it expires, or reports a failure,
+    the batch is handed out again, at most retries times in all.
+    """
+
+    def __init__(self, batches, store, settings, campaign=None, lease=DEFAULT_LEASE, retries=3, max_batches=None):
+        # (batch_id, configs) of the batches still to be drawn
+        self.batches = batches
+        self.store = store
+        self.campaign = campaign
+
+        # what every worker needs to know to run a batch, sent in reply to hello
+        self.settings = settings
+
+        self.lease_time = lease
+        self.retries = retries
+        self.max_batches = max_batches
+
+        # (batch_id, configs, attempts) of batches to be handed out again
+        self.pending = collections.deque()
+        # batch_id -> [configs, attempts, deadline, worker]
+        self.leases = {}
+
+        self.drawn = 0
+        self.done = 0
+        self.failed = 0
+
+        # set once no more batches are drawn, e.g. on SIGINT
+        self.draining = False
+
+    def handle(self, message):
+        handlers = {
+            'hello': self.hello,
+            'lease': self.lease,
+            'renew': self.renew,
+            'result': self.result,
+            'fail': self.fail,
+        }
+
+        op = message.pop('op', None)
+        if op not in handlers:
+            return {'error': f'invalid op: {op}'}
+
+        try:
+            return handlers[op](**message)
+        except TypeError:
+            return {'error': f'invalid arguments for {op}'}
+
+    def hello(self, worker):
+        print(f'{worker} connected')
+        return self.settings
+
+    def _draw(self):
+        if self.draining or (self.max_batches is not None and self.drawn >= self.max_batches):
+            return None
+
+        try:
+            batch_id, configs = next(self.batches)
+        except StopIteration:
+            self.draining = True
+            return None
+
+        self.drawn += 1
+        return batch_id, configs, 0
+
+    def lease(self, worker):
+        self.expire()
+
+        if self.pending:
+            batch = self.pending.popleft()
+        else:
+            batch = self._draw()
+
+        if batch is None:
+            return {'wait': RETRY_WAIT} if self.leases else {'done': True}
+
+        batch_id, configs, attempts = batch
+        if self.campaign is not None:
+            # remote workers always start a batch over, so its checkpoint is not needed
+            self.campaign.start(batch_id)
+
+        self.leases[batch_id] = [configs, attempts + 1, time.monotonic() + self.lease_time, worker]
+
+        return {'batch': batch_id, 'configs': configs, 'lease': self.lease_time}
+
+    def renew(self, worker, batch):
+        lease = self.leases.get(batch)
+        if lease is None or lease[3] != worker:
+            return {'ok': False}
+
+        lease[2] = time.monotonic() + self.lease_time
+        return {'ok': True}
+
+    def result(self, worker, batch, results, traces=None):
+        if batch in self.leases:
+            del self.leases[batch]
+        else:
+            # the lease expired, but the batch was not finished by another worker yet
+            pending = [entry for entry in self.pending if entry[0] == batch]
+            if not pending:
+                return {'ok': False}
+            self.pending.remove(pending[0])
+
+        self.store.add(results, traces)
+        if self.campaign is not None:
+            self.campaign.finish(batch)
+
+        self.done += 1
+        print(f'batch {batch} done by {worker}: ' + ', '.join(result['termination'].split('.')[0] for result in results))
+
+        return {'ok': True}
+
+    def fail(self, worker, batch, error=None):
+        lease = self.leases.get(batch)
+        if lease is None or lease[3] != worker:
+            return {'ok': False}
+
+        del self.leases[batch]
+        print(f'batch {batch} failed on {worker}: {error}')
+        self._retry(batch, lease[0], lease[1])
+
+        return {'ok': True}
+
+    def _retry(self, batch_id, configs, attempts):
+        if attempts < self.retries:
+            self.pending.append((batch_id, configs, attempts))
+        else:
+            self.failed += 1
+            print(f'batch {batch_id} given up after {attempts} attempts')
+            if self.campaign is not None:
+                self.campaign.fail(batch_id)
+
+    def expire(self):
+        """
+        Takes back the batches whose leases expired.
+        """
+
+        now = time.monotonic()
+        for batch_id, (configs, attempts, deadline, worker) in list(self.leases.items()):
+            if deadline < now:
+                del self.leases[batch_id]
+                print(f'lease of batch {batch_id} by {worker} expired')
+                self._retry(batch_id, configs, attempts)
+
+    def finished(self):
+        return (self.draining or (self.max_batches is not None and self.drawn >= self.max_batches)) and not self.pending \
+            and not self.leases
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    timeout = TIMEOUT
+
+    def handle(self):
+        try:
+            message = json.loads(self.rfile.readline())
+        except (ValueError, OSError):
+            return
+
+        if isinstance(message, dict):
+            reply = self.server.coordinator.handle(message)
+        else:
+            reply = {'error': 'invalid request'}
+
+        self.wfile.write(json.dumps(reply).encode() + b'\n')
+
+class TCPServer(socketserver.TCPServer):
+    allow_reuse_address = True
+
+def make_server(address, coordinator):
+    family, address = parse_address(address)
+
+    if family == socket.AF_UNIX:
+        # a socket left behind by a coordinator that did not exit cleanly
+        if os.path.exists(address):
+            os.unlink(address)
+        server = socketserver.UnixStreamServer(address, RequestHandler)
+    else:
+        server = TCPServer(address, RequestHandler)
+
+    server.coordinator = coordinator
+    server.timeout = RETRY_WAIT
+
+    return server
+
+class RemoteStore():
+    """
+    Stands in for a ResultStore in run_search, sending the results of the current batch to the coordinator.
+    """
+
+    def __init__(self, address, worker, patience):
+        self.address = address
+        self.worker = worker
+        self.patience = patience
+        self.batch = None
+
+    def add(self, results, traces=None):
+        message = {'op': 'result', 'worker': self.worker, 'batch': self.batch, 'results': results, 'traces': traces}
+
+        # the batch is run again elsewhere if its results never arrive
+        deadline = time.monotonic() + self.patience
+        while True:
+            try:
+                request(self.address, dict(message))
+                return
+            except OSError:
+                if time.monotonic() >= deadline:
+                    raise
+                time.sleep(RETRY_WAIT)
+
+def keep_leased(address, worker, batch, lease, stop):
+    while not stop.wait(lease / 3):
+        try:
+            request(address, {'op': 'renew', 'worker': worker, 'batch': batch})
+        except OSError:
+            pass
+
+def work(address, settings, cache=True, geometries=None, patience=60):
+    """
+    Runs batches leased from the coordinator at address until it is done or has been unreachable for patience seconds.
+    """
+
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+    worker = f'{socket.gethostname()}:{os.getpid()}'
+    store = RemoteStore(address, worker, patience)
+
+    automata = WarmAutomata(cache, geometries)
+
+    last_contact = time.monotonic()
+    while True:
+        try:
+            reply = request(address, {'op': 'lease', 'worker': worker})
+        except OSError:
+            if time.monotonic() - last_contact > patience:
+                print(f'{worker}: coordinator unreachable, exiting')
+                break
+            time.sleep(RETRY_WAIT)
+            continue
+
+        last_contact = time.monotonic()
+
+        if reply.get('done'):
+            break
+        if 'wait' in reply:
+            time.sleep(reply['wait'])
+            continue
+
+        configs = [tuple(config) for config in reply['configs']]
+
+        stop = threading.Event()
+        renewer = threading.Thread(target=keep_leased, args=(address, worker, reply['batch'], reply['lease'], stop), daemon=True)
+        renewer.start()
+
+        store.batch = reply['batch']
+        try:
+            run_search(None, configs, cache=cache, history=settings['history'], automaton=automata.get(configs), store=store,
+                       trace=settings['trace'], early_stop=settings['early_stop'], symmetry=settings['symmetry'])
+        except Exception as e:
+            traceback.print_exc()
+            try:
+                request(address, {'op': 'fail', 'worker': worker, 'batch': reply['batch'], 'error': repr(e)})
+            except OSError:
+                pass
+        finally:
+            stop.set()
+            renewer.join()
+
+def serve(args):
+    seeds = check_search_arguments(args)
+
+    campaign = None
+    if args.campaign is not None:
+        campaign = Campaign(args.campaign)
+        batches = campaign_batches(campaign, args.layers, args.init_prob, args.init_limit, args.batch, seeds=seeds)
+    else:
+        batches = enumerate(config_generator(args.layers, args.init_prob, args.init_limit, args.batch, seeds=seeds))
+
+    settings = {
+        'layers': args.layers,
+        'history': args.history,
+        'trace': args.trace,
+        'early_stop': args.early_stop,
+        'symmetry': args.symmetry,
+    }
+
+    store = ResultStore(args.database)
+    coordinator = Coordinator(batches, store, settings, campaign=campaign, lease=args.lease, retries=args.retries,
+                              max_batches=args.max_batches)
+
+    def graceful_shutdown(signum, frame):
+        if not coordinator.draining:
+            coordinator.draining = True
+            os.write(sys.stdout.fileno(), b'Stopping after leased batches finish. Press Ctrl + C again to force quit.\n')
+        else:
+            sys.exit(0)
+
+    signal.signal(signal.SIGINT, graceful_shutdown)
+    signal.signal(signal.SIGTERM, graceful_shutdown)
+
+    with make_server(args.address, coordinator) as server:
+        print(f'serving on {args.address}', flush=True)
+
+        while not coordinator.finished():
+            server.handle_request()
+            coordinator.expire()
+
+        # tell workers still polling that there is nothing left
+        linger = time.monotonic() + LINGER
+        while time.monotonic() < linger:
+            server.handle_request()
+
+    if parse_address(args.address)[0] == socket.AF_UNIX:
+        os.unlink(args.address)
+
+    store.close()
+    if campaign is not None:
+        campaign.close()
+
+    print(f'{coordinator.done} batches done, {coordinator.failed} given up')
+
+def run_workers(args):
+    worker = f'{socket.gethostname()}:{os.getpid()}'
+
+    deadline = time.monotonic() + args.patience
+    while True:
+        try:
+            settings = request(args.address, {'op': 'hello', 'worker': worker})
+            break
+        except OSError:
+            if time.monotonic() >= deadline:
+                raise RuntimeError(f'coordinator at {args.address} is unreachable')
+            time.sleep(RETRY_WAIT)
+
+    # shared by all workers of this host, see search_many.py
+    geometries = {(p, q, settings['layers']): load_geometry(p, q, settings['layers'], cache=args.cache) for p, q in GEOMETRIES}
+
+    context = multiprocessing.get_context('fork')
+    processes = [context.Process(target=work, args=(args.address, settings, args.cache, geometries, args.patience))
+                 for _ in range(args.jobs)]
+    for process in processes:
+        process.start()
+
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        for process in processes:
+            process.kill()
+
+def main():
+    parser = argparse.ArgumentParser(description='run search_many.py searches on workers on any number of hosts')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    serve_parser = subparsers.add_parser('serve', help='hand out batches of configs and store the results workers send back')
+    serve_parser.add_argument('address', help='HOST:PORT to listen on, or the path of a Unix socket')
+    serve_parser.add_argument('-d', '--database', help='SQLite database to store the results in (see results.py)', type=Path,
+                              required=True)
+    add_search_arguments(serve_parser)
+    serve_parser.add_argument('--trace', help='also store the compressed output of every run', action='store_true')
+    serve_parser.add_argument('-c', '--campaign', help='manifest of the campaign, which is resumed if it exists. tried rules are never drawn again',
+                              type=Path)
+    serve_parser.add_argument('--lease', help=f'seconds before a batch of an unresponsive worker is handed out again. default: {DEFAULT_LEASE}',
+                              type=float, default=DEFAULT_LEASE)
+    serve_parser.add_argument('--retries', help='number of times a batch is handed out before giving up on it. default: 3', type=int, default=3)
+    serve_parser.add_argument('--max-batches', help='stop after this many batches. default: unlimited', type=int)
+
+    work_parser = subparsers.add_parser('work', help='run batches handed out by a coordinator')
+    work_parser.add_argument('address', help='HOST:PORT or Unix socket path of the coordinator')
+    work_parser.add_argument('-j', '--jobs', help='default: 1', type=int, default=1)
+    work_parser.add_argument('--no-cache', help='always build the tiling instead of using the tiling cache', dest='cache', action='store_false')
+    work_parser.add_argument('--patience', help='seconds to wait for an unreachable coordinator before exiting. default: 60', type=float,
+                             default=60)
+
+    args = parser.parse_args()
+
+    if args.command == 'serve':
+        serve(args)
+    else:
+        run_workers(args)
+
+if __name__ == '__main__':
+    main()
@@ -1,44 +1,93 @@
 #!/usr/bin/env python3
 
-import random
 import threading
 import signal
 import sys
 import argparse
 import matplotlib.pyplot as plt
 
+from pathlib import Path
+
 from hypergol.automaton import HyperbolicAutomaton
+from hypergol.kernels import BACKENDS
+from hypergol.metrics import METRICS
 from hypergol.shell import HypergolShell
 
+def check_snapshot(automaton, args):
+    """
+    Checks the p and q given along with --load against the loaded automaton, and sets the rule if one was given.
+    """
+
+    if args.p is not None and (args.p, args.q) != (automaton.geometry.p, automaton.geometry.q):
+        raise RuntimeError(f'the snapshot is of the {{{automaton.geometry.p}, {automaton.geometry.q}}} tiling')
+
+    if args.rule is not None:
+        automaton.set_rule(args.rule)
+
 def main():
     parser = argparse.ArgumentParser(
         prog='hypergol',
         description='Hyperbolic cellular automata simulator'
     )
 
-    parser.add_argument('p', help='number of sides to a polygon', type=int)
-    parser.add_argument('q', help='number of polygons around a vertex', type=int)
-    parser.add_argument('rule', help='format: b[0-9 ]+s[0-9 ]+', type=str)
-    parser.add_argument('-l', '--layers', help='number of layers to initially generate. default: 5', type=int, required=False, default=5)
+    parser.add_argument('p', help='number of sides to a polygon. taken from the snapshot with --load', type=int, nargs='?')
+    parser.add_argument('q', help='number of polygons around a vertex. taken from the snapshot with --load', type=int, nargs='?')
+    parser.add_argument('rule', help='format: b[0-9 ]+s[0-9 ]+. replaces the rule of the snapshot with --load', type=str, nargs='?')
+    parser.add_argument('-l', '--layers', help='number of layers to initially generate. default: 5', type=int, required=False)
     parser.add_argument('-s', '--seed', type=int)
     parser.add_argument('-p', '--init-prob', help='probability of making a cell alive during random automaton initialization', type=float)
     parser.add_argument('-n', '--init-limit', help='limit number of cells to randomize at initialization', type=int)
+    parser.add_argument('--init-layers', help='only randomize cells in this many innermost layers at initialization', type=int)
+    parser.add_argument('--init-radius', help='only randomize cells within this hyperbolic distance of the center at initialization',
+                        type=float)
+    parser.add_argument('-b', '--backend', help='step engine. default: auto (chosen by cell count)', choices=('auto', *BACKENDS), default='auto')
+    parser.add_argument('-i', '--incremental', help='only re-evaluate cells near the ones that changed in the last generation', action='store_true')
+    parser.add_argument('--no-cache', help='always build the tiling instead of using the tiling cache', dest='cache', action='store_false')
+    parser.add_argument('-x', '--auto-expand', help='grow the tiling when alive cells near its boundary and trim dead outer layers',
+                        action='store_true')
+    parser.add_argument('--max-layers', help='number of layers the tiling may grow to with --auto-expand. default: 7, or -l if greater', type=int)
+    parser.add_argument('--metrics', help='time the hot paths, see the stats command', action='store_true')
+    parser.add_argument('--load', help='start from a snapshot written by the save command', type=Path, metavar='SNAPSHOT')
 
     args = parser.parse_args()
 
-    if args.layers < 1:
+    if args.p is not None and args.q is None:
+        raise RuntimeError('p and q must be given together')
+
+    if args.seed is not None and args.seed < 0:
+        raise RuntimeError('seed must not be negative')
+
+    if args.load is None and args.layers is None:
+        args.layers = 5
+
+    if args.layers is not None and args.layers < 1:
         raise RuntimeError('number of layers must be greater than 0')
 
-    random.seed(args.seed)
+    if args.max_layers is not None and not args.auto_expand:
+        raise RuntimeError('--max-layers must be used with --auto-expand')
+
+    if args.metrics:
+        METRICS.enable()
+
+    if args.load is not None:
+        given = [option for option, value in (('-l', args.layers), ('--init-prob', args.init_prob), ('--init-limit', args.init_limit),
+                                              ('--init-layers', args.init_layers), ('--init-radius', args.init_radius)) if value is not None]
+        if given:
+            raise RuntimeError(f'--load cannot be used with {", ".join(given)}')
 
-    automaton = HyperbolicAutomaton(args.rule, args.p, args.q, args.layers)
+        automaton = HyperbolicAutomaton.load(args.load, backend=args.backend, incremental=args.incremental, cache=args.cache,
+                                             auto_expand=args.auto_expand, max_layers=args.max_layers, seed=args.seed)
+        check_snapshot(automaton, args)
+    elif args.rule is None:
+        raise RuntimeError('p, q and rule are required without --load')
+    else:
+        automaton = HyperbolicAutomaton(args.rule, args.p, args.q, args.layers, backend=args.backend, incremental=args.incremental,
+                                        cache=args.cache, auto_expand=args.auto_expand, max_layers=args.max_layers, seed=args.seed)
 
-    if args.init_prob and args.init_limit:
-        automaton.randomize(p_alive=args.init_prob, limit=args.init_limit)
-    elif args.init_prob:
-        automaton.randomize(p_alive=args.init_prob)
-    elif args.init_limit:
-        raise RuntimeError('--init-limit must be used with --init-prob')
+    if args.init_prob:
+        automaton.randomize(p_alive=args.init_prob, limit=args.init_limit, layers=args.init_layers, radius=args.init_radius)
+    elif args.init_limit or args.init_layers or args.init_radius:
+        raise RuntimeError('--init-limit, --init-layers and --init-radius must be used with --init-prob')
 
     with HypergolShell(automaton) as shell:
         plt.ion()
@@ -55,15 +104,10 @@ def main():
         io_thread = threading.Thread(target=shell.cmdloop)
         io_thread.start()
 
+        # draws the latest state whenever the shell or the running automaton published one
         while not shell.dead.is_set():
-            try:
-                shell.draw_barrier.wait(1)
-            except threading.BrokenBarrierError:
-                shell.draw_barrier.reset()
-                continue
-            shell.draw()
-
-        shell.draw_barrier.abort()
+            if shell.frame_ready.wait(1):
+                shell.draw()
 
         io_thread.join()
 
@@ -1,117 +1,549 @@
 #!/usr/bin/env python3
 
 import re
-import random
-import types
+import math
 import enum
+import struct
 
-from hypertiling import HyperbolicTiling
-from hypertiling.arraytransformation import morigin
-from hypertiling.distance import disk_distance
+from pathlib import Path
 
-def fixed_translate(self, z):
+import numpy as np
+
+from hypergol.kernels import select_backend, get_kernel, step_frontier
+from hypergol.metrics import METRICS
+from hypergol.tiling import TilingGeometry, CenterIndex, load_geometry
+
+# incremental stepping falls back to a full sweep when more than this fraction of cells changed
+FRONTIER_MAX_FRACTION = 0.25
+
+# layers an auto-expanding tiling keeps beyond the outermost alive cell: the cells that alive cell can give birth to,
+# and the outermost layer, whose cells lack the neighbors outside the tiling
+EXPAND_LAYERS = 2
+
+# an auto-expanding tiling is only trimmed once it has this many more dead layers than it needs
+TRIM_SLACK = 2
+
+# layers an auto-expanding tiling may grow to unless told otherwise. a spreading pattern adds about a layer per
+# generation and cells multiply with every layer; 7 layers of the {6, 4} tiling are already 100381 cells
+AUTO_EXPAND_MAX_LAYERS = 7
+
+# snapshot files: a header, the rule, the geometry operations since the first move and the bit-packed states.
+# bump SNAPSHOT_VERSION whenever the format changes
+SNAPSHOT_MAGIC = b'HGOL'
+SNAPSHOT_VERSION = 1
+# magic, version, p, q, n, layers, generation, cells, rule length, operations
+SNAPSHOT_HEADER = struct.Struct('<4sHHHHHQQHI')
+# operation code and argument
+SNAPSHOT_OP = struct.Struct('<Bq')
+OP_TRANSLATE, OP_EXPAND, OP_TRIM = range(3)
+
+# Moebius transforms of the disk are kept as elements (a, b) of SU(1, 1), the matrices [[a, b], [conj(b), conj(a)]]
+# with |a|^2 - |b|^2 = 1
+IDENTITY = (1 + 0j, 0j)
+
+def mobius(transform, z, out=None):
+    """
+    Applies transform to the array of points z: z -> (a z + b) / (conj(b) z + conj(a)).
+    """
+
+    a, b = transform
+    return np.divide(a * z + b, b.conjugate() * z + a.conjugate(), out=out)
+
+def translation(z):
+    """
+    Returns the transform that moves the point z to the origin, z -> (z - z0) / (1 - conj(z0) z).
+    """
+
+    s = math.sqrt(1 - abs(z) ** 2)
+    return 1 / s, -z / s
+
+def compose(outer, inner):
+    """
+    Returns the transform applying inner, then outer. The result is renormalized onto SU(1, 1), so that rounding
+    errors cannot build up over many compositions.
+    """
+
+    a1, b1 = outer
+    a2, b2 = inner
+
+    a = a1 * a2 + b1 * b2.conjugate()
+    b = a1 * b2 + b1 * a2.conjugate()
+
+    norm = math.sqrt(abs(a) ** 2 - abs(b) ** 2)
+    return a / norm, b / norm
+
+def transpose_index(indptr, indices):
+    """
+    Transposes a CSR neighbor index, so that row j lists the cells which have j as a neighbor.
+    """
+
+    n = len(indptr) - 1
+    rows = np.repeat(np.arange(n, dtype=np.int64), np.diff(indptr))
+
+    t_indptr = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(np.bincount(indices, minlength=n), out=t_indptr[1:])
+    t_indices = rows[np.argsort(indices, kind='stable')]
+
+    return t_indptr, t_indices
+
+def parse_rule(rule_str):
     """
-    Translates the whole tiling so that the point z lays in the origin.
+    Parses a rule of the format b[0-9 ]+s[0-9 ]+, where '_' may be used instead of spaces.
 
-    Parameters
-    ----------
-    z: complex
-        The point which will be translated to the origin.
+    Returns
+    -------
+    (born, survive): tuple of set of int
     """
 
-    for index, poly in self.polygons.items():
-        morigin(self.p, z, poly.get_polygon())
+    rule_str = rule_str.replace('_', ' ')
+    matches = re.fullmatch(r'b([0-9 ]*)s([0-9 ]*)', rule_str)
+
+    if not matches:
+        raise RuntimeError('invalid rule str')
+
+    born_str = matches[1]
+    survive_str = matches[2]
+
+    return set(map(int, born_str.split())), set(map(int, survive_str.split()))
+
+def format_rule(born, survive):
+    return ' '.join((
+        'b',
+        ' '.join(str(i) for i in born),
+        's',
+        ' '.join(str(i) for i in survive)
+    ))
+
+def rule_table(born, survive, max_nbrs):
+    """
+    Builds the lookup table of a rule: table[alive][n] is 1 if a cell with n alive neighbors is alive in the next
+    generation. It covers at least max_nbrs neighbors.
+    """
+
+    table = np.zeros((2, max((max_nbrs, *born, *survive)) + 1), dtype=np.uint8)
+    table[0, list(born)] = 1
+    table[1, list(survive)] = 1
+
+    return table
+
+def random_states(geometry, p_alive, rng, limit=None, layers=None, radius=None):
+    """
+    Draws the initial states of the cells of geometry from the numpy Generator rng. A cell is alive with probability
+    p_alive if it is one of the first limit cells, lies in the innermost layers layers and its center is within
+    hyperbolic distance radius of the center of cell 0; the rest are dead. Random values are only drawn for these cells.
+    """
+
+    # cells are ordered by layer, so the first two bounds cut a prefix
+    size = len(geometry)
+    if limit is not None:
+        size = min(size, limit)
+    if layers is not None:
+        size = min(size, int(np.searchsorted(geometry.layers, layers)))
+
+    states = np.full(len(geometry), HyperbolicAutomaton.States.DEAD, dtype=np.uint8)
+    if p_alive <= 0 or size <= 0:
+        return states
+
+    if radius is None:
+        states[:size] = rng.random(size) < p_alive
+    else:
+        centers = geometry.polygons[:size, -1]
+        center = centers[0]
+        ratio = np.minimum(np.abs(centers - center) / np.abs(1 - np.conj(center) * centers), 1)
+        cells = np.flatnonzero(2 * np.arctanh(ratio) <= radius)
+        states[cells] = rng.random(len(cells)) < p_alive
+
+    return states
 
 class HyperbolicAutomaton():
-    class States(enum.Enum):
-        ALIVE = enum.auto()
-        DEAD = enum.auto()
+    class States(enum.IntEnum):
+        # values double as the contents of the uint8 state array
+        ALIVE = 1
+        DEAD = 0
+
+    def __init__(self, rule_str, p, q, n, init_prob=None, init_limit=None, backend='auto', incremental=False, cache=True,
+                 auto_expand=False, max_layers=None, geometry=None, seed=None, init_layers=None, init_radius=None):
+        self.backend = backend
+
+        # randomize() draws from this numpy Generator. seed is anything np.random.default_rng takes, e.g. an int or a
+        # SeedSequence spawned for a job
+        self.rng = np.random.default_rng(seed)
+
+        # with auto_expand, step() grows the tiling, up to max_layers layers, whenever alive cells come near its
+        # boundary, and trims dead outer layers again
+        self.auto_expand = auto_expand
+        if auto_expand and max_layers is None:
+            max_layers = max(n, AUTO_EXPAND_MAX_LAYERS)
+        self.max_layers = max_layers
+
+        # in incremental mode, _frontier holds the cells changed since the rule was last applied to every cell,
+        # or None when a full sweep is needed. states must then only be modified through this class' methods
+        self.incremental = incremental
+        self._frontier = None
+
+        # stepping only needs the geometry's arrays; the tiling is built from them on first use
+        self.cache = cache
+        # a geometry loaded before forking, e.g. by search_many.py, is shared by all processes instead of each loading its own
+        self.geometry = load_geometry(p, q, n, cache=cache) if geometry is None else geometry
+        self._tiling = None
 
-    def __init__(self, rule_str, *args, init_prob=None, init_limit=None):
-        self.tiling = HyperbolicTiling(*args, kernel='SRG')
-        self.tiling.translate = types.MethodType(fixed_translate, self.tiling)
+        # until the first move, the tiling is the innermost layers of the cached tiling with more layers
+        self._moved = False
 
-        self.center = self.tiling.get_center(0)
+        # a moved tiling cannot be loaded from the cache, so snapshots record the number of layers at the first move
+        # and the (operation, argument) that changed the geometry since, to be replayed when loading
+        self._moved_layers = None
+        self._operations = []
+
+        self.center = self.geometry.polygons[0, -1]
+
+        # geometry.polygons are transform applied to _base, the coordinates as of the last growth of the tiling.
+        # moving only composes transforms, so coordinates are always a single transform away from _base
+        self.transform = IDENTITY
+        self._base = None
+        self._transform_applied = True
+
+        # generations stepped so far
+        self.generation = 0
+
+        # population is the number of alive cells; births and deaths count the changes of the last step
+        self.population = 0
+        self.births = 0
+        self.deaths = 0
+
+        self._build_index()
 
         if init_prob is None:
             init_prob = 0
 
-        self.randomize(init_prob, limit=init_limit)
+        self.randomize(init_prob, limit=init_limit, layers=init_layers, radius=init_radius)
 
         self.set_rule(rule_str)
 
+    @property
+    def tiling(self):
+        if self._tiling is None:
+            # the tiling is built from the coordinates before any move, which is what its duplicate container holds
+            # when growing; its polygons are views into geometry.polygons, so the moves are applied afterwards
+            if self._base is not None:
+                self.geometry.polygons[:] = self._base
+                self._transform_applied = False
+            self._tiling = self.geometry.build_tiling()
+            self.apply_transform()
+        return self._tiling
+
     def get_rule(self):
-        return ' '.join((
-            'b',
-            ' '.join(str(i) for i in self._born),
-            's',
-            ' '.join(str(i) for i in self._survive)
-        ))
+        return format_rule(self._born, self._survive)
 
     def set_rule(self, rule_str):
-        rule_str = rule_str.replace('_', ' ')
-        matches = re.fullmatch(r'b([0-9 ]*)s([0-9 ]*)', rule_str)
+        self._born, self._survive = parse_rule(rule_str)
+        self._build_rule_table()
+        self._frontier = None
+
+    def _build_index(self):
+        self._nbr_indptr, self._nbr_indices = self.geometry.indptr, self.geometry.indices
+        self._max_nbrs = int(np.diff(self._nbr_indptr).max(initial=0))
 
-        if not matches:
-            raise RuntimeError('invalid rule str')
+        # the transposed index is only needed, and built, by incremental stepping
+        self._dep_indptr = self._dep_indices = None
 
-        born_str = matches[1]
-        survive_str = matches[2]
+        # 'auto' is resolved again whenever the tiling grows
+        self._step_kernel = get_kernel(select_backend(self.backend, len(self._nbr_indptr) - 1))
 
-        self._born = set(map(int, born_str.split()))
-        self._survive = set(map(int, survive_str.split()))
+        self._frontier = None
+
+    def _build_rule_table(self):
+        self._rule_table = rule_table(self._born, self._survive, self._max_nbrs)
+
+    def get(self, index):
+        return self.States(self.states[index])
 
     def set(self, index, alive=True):
+        old = self.states[index]
         self.states[index] = self.States.ALIVE if alive else self.States.DEAD
+        self.population += int(self.states[index]) - int(old)
+        self._touch(index)
 
     def toggle(self, index):
-        if self.states[index] == self.States.DEAD:
-            self.states[index] = self.States.ALIVE
-        else:
-            self.states[index] = self.States.DEAD
-
-    def translate(self, index):
-        self.center = self.tiling.get_center(index)
-        self.tiling.translate(self.center)
-
-        def existing_cell_filter(z):
-            cutoff = 0.05
-            for poly in self.tiling.polygons.values():
-                center = poly.get_polygon()[-1]
-                dist = disk_distance(z, center)
-                if dist < cutoff:
-                    return False
-            return True
-
-        if len(self.tiling.get_nbrs(index)) < len(self.tiling.get_nbrs(0)):
+        self.states[index] ^= 1
+        self.population += 1 if self.states[index] else -1
+        self._touch(index)
+
+    def clear(self):
+        self.states[:] = self.States.DEAD
+        self.population = 0
+        self._frontier = None
+
+    def _touch(self, index):
+        if self._frontier is not None:
+            self._frontier = np.append(self._frontier, index)
+
+    def translate(self, index, apply=True):
+        """
+        Moves the center of cell index to the origin. If apply is False, geometry.polygons keep their old coordinates
+        until apply_transform() is called, e.g. before rendering, so that several moves cost a single update.
+        """
+
+        if self._base is None:
+            self._base = self.geometry.polygons.copy()
+        if not self._moved:
+            self._moved_layers = self.layer_count()
+        self._moved = True
+        self._operations.append((OP_TRANSLATE, index))
+
+        self.center = complex(mobius(self.transform, self._base[index, -1]))
+        self.transform = compose(translation(self.center), self.transform)
+        self._transform_applied = False
+
+        nbr_counts = np.diff(self._nbr_indptr)
+        if nbr_counts[index] < nbr_counts[0]:
             print('adding layer...')
-            self.tiling.add_layer(filter=existing_cell_filter)
-            self.states += [self.States.DEAD] * (len(self.tiling) - len(self.states))
+            self.apply_transform()
+            with METRICS.timer('tiling_grow'):
+                self._add_layer()
+                self._grown()
+        elif apply:
+            self.apply_transform()
+
+    def layer_count(self):
+        return int(self.geometry.layers[-1]) + 1
+
+    def expand(self):
+        """
+        Adds a layer of dead cells around the tiling.
+        """
+
+        if self.cache and not self._moved:
+            geometry = load_geometry(self.geometry.p, self.geometry.q, self.layer_count() + 1)
+            geometry.n = self.geometry.n
+            self._set_geometry(geometry)
+            return
+
+        if self._moved:
+            self._operations.append((OP_EXPAND, 0))
+
+        self.apply_transform()
+
+        with METRICS.timer('tiling_grow'):
+            tiling = self.tiling
+
+            # unlike when growing after a move, the new layer is connected to the existing cells through the
+            # duplicate container, so it has to hold their current centers
+            tiling._prepare_duplicate_container()
+            for i, poly in tiling.polygons.items():
+                tiling.dplcts.add(poly.get_center(), i)
+
+            tiling.add_layer()
+            self._grown()
+
+    def trim(self, layers):
+        """
+        Removes every cell outside the innermost layers layers. Those cells must be dead.
+        """
+
+        self.apply_transform()
+        geometry = self.geometry.truncate(layers)
+
+        if self.states[len(geometry):].any():
+            raise RuntimeError('cannot trim layers with alive cells')
+
+        if self._moved:
+            self._operations.append((OP_TRIM, layers))
+
+        self._set_geometry(geometry)
+
+    def _grown(self):
+        self._set_geometry(TilingGeometry.from_tiling(self.tiling), tiling=self.tiling)
+
+    def _set_geometry(self, geometry, tiling=None):
+        """
+        Switches to geometry, whose cells start with the current ones, in their current positions. Added cells are dead.
+        """
+
+        dead = np.full(max(len(geometry) - len(self.states), 0), self.States.DEAD, dtype=np.uint8)
+        self.states = np.concatenate((self.states[:len(geometry)], dead))
+
+        self.geometry = geometry
+        self._tiling = tiling
+        self._build_index()
+        self._build_rule_table()
+
+        # the new geometry is the new base
+        self.transform = IDENTITY
+        self._base = None
+
+    def _fit(self):
+        """
+        Grows or trims the tiling to EXPAND_LAYERS layers beyond the outermost alive cell. Returns the number of
+        generations that can be stepped before an alive cell may come closer to the boundary than that.
+        """
+
+        # cells are ordered by layer, so the last alive cell is in the outermost layer of any
+        alive = np.flatnonzero(self.states)
+        outer = int(self.geometry.layers[alive[-1]]) if len(alive) else 0
 
-    def step(self):
-        new_states = []
+        layers = self.layer_count()
+        needed = outer + EXPAND_LAYERS + 1
 
-        for i in self.tiling.polygons:
-            neighbors = self.tiling.get_nbrs(i)
+        while layers < needed and (self.max_layers is None or layers < self.max_layers):
+            self.expand()
+            layers += 1
 
-            nbrs_alive = sum(int(self.states[neighbor] == self.States.ALIVE) for neighbor in neighbors)
+        if layers >= needed + TRIM_SLACK:
+            self.trim(needed)
+            layers = needed
 
-            if ((self.states[i] == self.States.ALIVE and nbrs_alive in self._survive)
-                    or (self.states[i] == self.States.DEAD and nbrs_alive in self._born)):
-                new_states.append(self.States.ALIVE)
+        # alive cells spread by at most one layer per generation
+        return max(layers - outer - EXPAND_LAYERS, 1)
+
+    def apply_transform(self):
+        """
+        Brings geometry.polygons, and the tiling whose polygons are views into them, up to date with the moves so far.
+        """
+
+        if not self._transform_applied:
+            mobius(self.transform, self._base, out=self.geometry.polygons)
+            self._transform_applied = True
+
+    def _add_layer(self):
+        # the duplicate container of the tiling still holds the centers from before any translation, so candidate
+        # cells closer than the cutoff to a cell's current center are filtered out instead. the index of the centers
+        # also learns every cell added by this layer
+        index = CenterIndex(self.geometry.polygons[:, -1].tolist(), cutoff=0.05)
+        add_pgon = self.tiling._add_pgon
+
+        def indexed_add_pgon(pgon):
+            index.add(pgon.get_center())
+            return add_pgon(pgon)
+
+        self.tiling._add_pgon = indexed_add_pgon
+        try:
+            self.tiling.add_layer(filter=lambda z: not index.any_within(z))
+        finally:
+            del self.tiling._add_pgon
+
+    def step(self, generations=1):
+        with METRICS.timer('step'):
+            if not self.auto_expand:
+                self._step(generations)
+            else:
+                remaining = generations
+                while remaining > 0:
+                    chunk = min(remaining, self._fit())
+                    self._step(chunk)
+                    remaining -= chunk
+
+        self.generation += generations
+
+        METRICS.count('generations', generations)
+        METRICS.count('cells', len(self.states) * generations)
+
+    def _step(self, generations):
+        if not self.incremental:
+            self.states, births, deaths = self._step_kernel(self.states, self._nbr_indptr, self._nbr_indices, self._rule_table,
+                                                            generations)
+            # population can only be followed through the births and deaths of a single generation
+            if generations == 1:
+                self._count(births, deaths)
             else:
-                new_states.append(self.States.DEAD)
+                self.births, self.deaths = births, deaths
+                self.population = int(np.count_nonzero(self.states))
+            return
+
+        for _ in range(generations):
+            if self._frontier is None or len(self._frontier) > FRONTIER_MAX_FRACTION * len(self.states):
+                new_states, births, deaths = self._step_kernel(self.states, self._nbr_indptr, self._nbr_indices, self._rule_table)
+                self._frontier = np.flatnonzero(new_states != self.states)
+                self.states = new_states
+            else:
+                if self._dep_indptr is None:
+                    self._dep_indptr, self._dep_indices = transpose_index(self._nbr_indptr, self._nbr_indices)
+                self._frontier, births = step_frontier(self.states, self._nbr_indptr, self._nbr_indices,
+                                                       self._dep_indptr, self._dep_indices, self._rule_table, self._frontier)
+                deaths = len(self._frontier) - births
+            self._count(births, deaths)
+
+    def _count(self, births, deaths):
+        self.births = births
+        self.deaths = deaths
+        self.population += births - deaths
+
+    def set_states(self, states):
+        # states of an auto-expanding automaton may come from a grown or trimmed tiling
+        while len(states) > len(self.geometry):
+            self.expand()
+        if len(states) < len(self.geometry):
+            self.trim(int(self.geometry.layers[len(states)]))
 
-        self.states = new_states
+        self.states = np.array(states, dtype=np.uint8)
+        self.population = int(np.count_nonzero(self.states))
+        self._frontier = None
 
-    def randomize(self, p_alive, limit=None):
-        if limit is None:
-            limit = len(self.tiling)
+    def randomize(self, p_alive, limit=None, layers=None, radius=None):
+        self.states = random_states(self.geometry, p_alive, self.rng, limit=limit, layers=layers, radius=radius)
+        self.population = int(np.count_nonzero(self.states))
+        self._frontier = None
+
+    def save(self, path):
+        """
+        Writes the rule, generation, states and what it takes to rebuild the tiling to the snapshot file path.
+        """
+
+        rule = self.get_rule().encode()
+        layers = self.layer_count() if not self._moved else self._moved_layers
+
+        header = SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, self.geometry.p, self.geometry.q, self.geometry.n, layers,
+                                      self.generation, len(self.states), len(rule), len(self._operations))
+        operations = b''.join(SNAPSHOT_OP.pack(*operation) for operation in self._operations)
+
+        Path(path).write_bytes(header + rule + operations + np.packbits(self.states).tobytes())
+
+    @classmethod
+    def load(cls, path, **kwargs):
+        """
+        Reads an automaton saved by save(). Unless it was moved, its tiling is taken from the tiling cache; otherwise
+        the moves are replayed. kwargs are passed on to the constructor, e.g. backend or auto_expand.
+        """
+
+        data = Path(path).read_bytes()
+
+        try:
+            magic, version, p, q, n, layers, generation, cells, rule_length, n_operations = SNAPSHOT_HEADER.unpack_from(data)
+        except struct.error:
+            raise RuntimeError(f'not a hypergol snapshot: {path}')
+        if magic != SNAPSHOT_MAGIC:
+            raise RuntimeError(f'not a hypergol snapshot: {path}')
+        if version != SNAPSHOT_VERSION:
+            raise RuntimeError(f'unsupported snapshot version {version}: {path}')
+
+        offset = SNAPSHOT_HEADER.size
+        rule = data[offset:offset + rule_length].decode()
+        offset += rule_length
+
+        operations = [SNAPSHOT_OP.unpack_from(data, offset + i * SNAPSHOT_OP.size) for i in range(n_operations)]
+        offset += n_operations * SNAPSHOT_OP.size
+
+        if len(data) - offset != (cells + 7) // 8:
+            raise RuntimeError(f'truncated snapshot: {path}')
+        states = np.unpackbits(np.frombuffer(data, dtype=np.uint8, offset=offset), count=cells)
+
+        automaton = cls(rule, p, q, layers, **kwargs)
+        automaton.geometry.n = n
+
+        for operation, argument in operations:
+            if operation == OP_TRANSLATE:
+                automaton.translate(argument, apply=False)
+            elif operation == OP_EXPAND:
+                automaton.expand()
+            elif operation == OP_TRIM:
+                automaton.trim(argument)
+            else:
+                raise RuntimeError(f'invalid snapshot operation {operation}: {path}')
 
-        states = []
-        for i in range(limit):
-            states.append(self.States.ALIVE if random.random() < p_alive else self.States.DEAD)
+        if len(automaton.geometry) != cells:
+            raise RuntimeError(f'snapshot does not match its tiling: {path}')
 
-        states += [self.States.DEAD] * (len(self.tiling) - limit)
+        automaton.set_states(states)
+        automaton.generation = generation
 
-        self.states = states
+        return automaton
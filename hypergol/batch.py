@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+
+import numpy as np
+
+from hypergol.automaton import HyperbolicAutomaton, parse_rule, format_rule, rule_table
+from hypergol.kernels import step_numpy_batch
+from hypergol.metrics import METRICS
+
+class BatchedAutomaton():
+    """
+    Many universes, each with its own rule, living on the tiling of one HyperbolicAutomaton and stepped together
+    against its neighbor index. Universes are identified by the id returned from add().
+    """
+
+    States = HyperbolicAutomaton.States
+
+    def __init__(self, automaton):
+        self.automaton = automaton
+        self.geometry = automaton.geometry
+
+        # one row per universe, in the order of self.ids
+        self.states = np.empty((0, len(self.geometry)), dtype=np.uint8)
+        self.population = np.empty(0, dtype=np.int64)
+        self.births = np.empty(0, dtype=np.int64)
+        self.deaths = np.empty(0, dtype=np.int64)
+        self._rule_tables = np.empty((0, 2, automaton._max_nbrs + 1), dtype=np.uint8)
+
+        self.ids = []
+        self._rows = {}
+        self._rules = {}
+        self._next_id = 0
+
+    def __len__(self):
+        return len(self.ids)
+
+    def add(self, rule_str, states):
+        born, survive = parse_rule(rule_str)
+        table = rule_table(born, survive, self.automaton._max_nbrs)
+
+        # all tables share the width of the widest rule
+        width = max(table.shape[1], self._rule_tables.shape[2])
+        table = np.pad(table, ((0, 0), (0, width - table.shape[1])))
+        self._rule_tables = np.pad(self._rule_tables, ((0, 0), (0, 0), (0, width - self._rule_tables.shape[2])))
+
+        self._rule_tables = np.concatenate((self._rule_tables, table[np.newaxis]))
+        self.states = np.concatenate((self.states, np.asarray(states, dtype=np.uint8)[np.newaxis]))
+        self.population = np.append(self.population, np.count_nonzero(states))
+        self.births = np.append(self.births, 0)
+        self.deaths = np.append(self.deaths, 0)
+
+        uid = self._next_id
+        self._next_id += 1
+
+        self._rows[uid] = len(self.ids)
+        self.ids.append(uid)
+        self._rules[uid] = (born, survive)
+
+        return uid
+
+    def remove(self, uids):
+        uids = set(uids)
+        if not uids:
+            return
+
+        keep = [row for row, uid in enumerate(self.ids) if uid not in uids]
+        self.states = self.states[keep]
+        self.population = self.population[keep]
+        self.births = self.births[keep]
+        self.deaths = self.deaths[keep]
+        self._rule_tables = self._rule_tables[keep]
+
+        self.ids = [uid for uid in self.ids if uid not in uids]
+        self._rows = {uid: row for row, uid in enumerate(self.ids)}
+        for uid in uids:
+            del self._rules[uid]
+
+    def get_states(self, uid):
+        return self.states[self._rows[uid]]
+
+    def set_states(self, uid, states):
+        row = self._rows[uid]
+        self.states[row] = states
+        self.population[row] = np.count_nonzero(states)
+
+    def get_counts(self, uid):
+        """
+        Returns (population, births, deaths) of a universe, births and deaths counted over its last step.
+        """
+
+        row = self._rows[uid]
+        return int(self.population[row]), int(self.births[row]), int(self.deaths[row])
+
+    def get_rule(self, uid):
+        return format_rule(*self._rules[uid])
+
+    def universe(self, uid):
+        return Universe(self, uid)
+
+    def step(self, generations=1):
+        with METRICS.timer('step'):
+            self.states, self.births, self.deaths = step_numpy_batch(self.states, self.automaton._nbr_indptr,
+                                                                     self.automaton._nbr_indices, self._rule_tables, generations)
+            if generations == 1:
+                self.population += self.births - self.deaths
+            else:
+                self.population = np.count_nonzero(self.states, axis=1)
+
+        METRICS.count('generations', generations * len(self.ids))
+        METRICS.count('cells', self.states.size * generations)
+
+class Universe():
+    """
+    View of one universe of a BatchedAutomaton, usable in place of a HyperbolicAutomaton by Search.
+    """
+
+    States = HyperbolicAutomaton.States
+
+    def __init__(self, batch, uid):
+        self.batch = batch
+        self.uid = uid
+        self.geometry = batch.geometry
+
+    @property
+    def states(self):
+        return self.batch.get_states(self.uid)
+
+    @property
+    def population(self):
+        return self.batch.get_counts(self.uid)[0]
+
+    @property
+    def births(self):
+        return self.batch.get_counts(self.uid)[1]
+
+    @property
+    def deaths(self):
+        return self.batch.get_counts(self.uid)[2]
+
+    def set_states(self, states):
+        self.batch.set_states(self.uid, states)
+
+    def get_rule(self):
+        return self.batch.get_rule(self.uid)
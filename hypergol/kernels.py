@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+
+import numpy as np
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+BACKENDS = ('python', 'numpy', 'numba')
+
+# below this many cells the numba kernel's thread startup outweighs its speedup
+NUMBA_MIN_CELLS = 20000
+
+# every step kernel returns (states, births, deaths), where births and deaths are the number of cells that became
+# alive or dead in the last of the stepped generations
+
+def step_python(states, indptr, indices, rule_table, generations=1):
+    states = states.tolist()
+    indptr = indptr.tolist()
+    indices = indices.tolist()
+    rule_table = rule_table.tolist()
+
+    previous = states
+    for _ in range(generations):
+        previous = states
+        states = [
+            rule_table[states[i]][sum(states[j] for j in indices[indptr[i]:indptr[i + 1]])]
+            for i in range(len(states))
+        ]
+
+    births = sum(new > old for new, old in zip(states, previous))
+    deaths = sum(new < old for new, old in zip(states, previous))
+
+    return np.array(states, dtype=np.uint8), births, deaths
+
+def step_numpy(states, indptr, indices, rule_table, generations=1):
+    nbrs_alive = np.zeros(len(indices) + 1, dtype=np.int64)
+
+    previous = states
+    for _ in range(generations):
+        previous = states
+        # number of alive neighbors of each cell: prefix sums over the gathered neighbor states, differenced at row bounds
+        np.cumsum(states[indices], out=nbrs_alive[1:])
+        states = rule_table[states, nbrs_alive[indptr[1:]] - nbrs_alive[indptr[:-1]]]
+
+    return states, int(np.count_nonzero(states > previous)), int(np.count_nonzero(states < previous))
+
+def step_numpy_batch(states, indptr, indices, rule_tables, generations=1):
+    """
+    Steps a (universes x cells) state matrix, where universe u follows the rule in rule_tables[u].
+    births and deaths are arrays with one entry per universe.
+    """
+
+    universes = np.arange(len(states))[:, None]
+    nbrs_alive = np.zeros((len(states), len(indices) + 1), dtype=np.int64)
+
+    previous = states
+    for _ in range(generations):
+        previous = states
+        np.cumsum(states[:, indices], axis=1, out=nbrs_alive[:, 1:])
+        states = rule_tables[universes, states, nbrs_alive[:, indptr[1:]] - nbrs_alive[:, indptr[:-1]]]
+
+    return states, np.count_nonzero(states > previous, axis=1), np.count_nonzero(states < previous, axis=1)
+
+if numba is not None:
+    @numba.njit(parallel=True, cache=True)
+    def step_numba(states, indptr, indices, rule_table, generations=1):
+        current = states.copy()
+        new = np.empty_like(states)
+        births = 0
+        deaths = 0
+
+        for _ in range(generations):
+            births = 0
+            deaths = 0
+            for i in numba.prange(len(current)):
+                nbrs_alive = 0
+                for k in range(indptr[i], indptr[i + 1]):
+                    nbrs_alive += current[indices[k]]
+                new[i] = rule_table[current[i], nbrs_alive]
+
+                if new[i] > current[i]:
+                    births += 1
+                elif new[i] < current[i]:
+                    deaths += 1
+
+            current, new = new, current
+
+        return current, births, deaths
+else:
+    step_numba = None
+
+def start_threads():
+    """
+    Starts numba's thread pool by running the parallel kernel once on a single cell. Must be called from the main thread
+    before any other thread steps with the numba backend: with numba's tbb threading layer, a pool first started from
+    another thread hangs the interpreter at exit.
+    """
+
+    if step_numba is not None:
+        step_numba(np.zeros(1, dtype=np.uint8), np.zeros(2, dtype=np.int64), np.zeros(0, dtype=np.int64),
+                   np.zeros((2, 1), dtype=np.uint8))
+
+def gather_rows(indptr, indices, rows):
+    """
+    Gathers the CSR rows of the given cells into one flat array.
+
+    Returns
+    -------
+    (flat, offsets): tuple of np.ndarray
+        The entries of row rows[k] are flat[offsets[k]:offsets[k + 1]].
+    """
+
+    starts = indptr[rows]
+    lengths = indptr[rows + 1] - starts
+
+    offsets = np.zeros(len(rows) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+
+    flat = indices[np.repeat(starts - offsets[:-1], lengths) + np.arange(offsets[-1])]
+
+    return flat, offsets
+
+def step_frontier(states, indptr, indices, dep_indptr, dep_indices, rule_table, frontier):
+    """
+    Updates states in place, re-evaluating only the cells in frontier and the cells that depend on them.
+    Every other cell must already be a fixed point of the rule, i.e. frontier holds all cells that changed
+    since the rule was last applied to the whole tiling.
+
+    Returns
+    -------
+    (changed, births): tuple of np.ndarray and int
+        changed are the cells that changed, which are the frontier of the next generation;
+        births is the number of them that became alive.
+    """
+
+    dependents, _ = gather_rows(dep_indptr, dep_indices, frontier)
+    cells = np.unique(np.concatenate((frontier, dependents)))
+
+    nbrs, offsets = gather_rows(indptr, indices, cells)
+    nbrs_alive = np.zeros(len(nbrs) + 1, dtype=np.int64)
+    np.cumsum(states[nbrs], out=nbrs_alive[1:])
+
+    new = rule_table[states[cells], nbrs_alive[offsets[1:]] - nbrs_alive[offsets[:-1]]]
+    changed = new != states[cells]
+
+    states[cells[changed]] = new[changed]
+
+    return cells[changed], int(np.count_nonzero(new[changed]))
+
+def select_backend(backend, n_cells):
+    if backend == 'auto':
+        if numba is not None and n_cells >= NUMBA_MIN_CELLS:
+            return 'numba'
+        return 'numpy'
+
+    if backend not in BACKENDS:
+        raise RuntimeError(f'invalid backend: {backend}')
+
+    if backend == 'numba' and numba is None:
+        raise RuntimeError('numba backend requested but numba is not installed')
+
+    return backend
+
+def get_kernel(backend):
+    return {
+        'python': step_python,
+        'numpy': step_numpy,
+        'numba': step_numba,
+    }[backend]
@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+
+import os
+import time
+import threading
+import contextlib
+
+from collections import deque
+
+# latencies kept per timer for its percentiles; older ones only count towards the totals
+SAMPLES = 4096
+
+PERCENTILES = (50, 90, 99)
+
+class Timer():
+    """
+    Number, total and maximum of the durations of a code path, and its latest SAMPLES durations.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.samples = deque(maxlen=SAMPLES)
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        self.samples.append(seconds)
+
+    def merge(self, other):
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+        self.samples.extend(other.samples)
+
+    def percentile(self, p):
+        samples = sorted(self.samples)
+        return samples[min(len(samples) - 1, len(samples) * p // 100)]
+
+    def summary(self):
+        summary = {'count': self.count, 'total': self.total, 'mean': self.total / self.count, 'max': self.max}
+        for p in PERCENTILES:
+            summary[f'p{p}'] = self.percentile(p)
+        return summary
+
+class Timing():
+    def __init__(self, timer):
+        self.timer = timer
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.timer.add(time.perf_counter() - self.start)
+
+class Metrics():
+    """
+    Timers, counters and peak values of the hot paths, collected only while enabled. Disabled, every method returns at
+    once and timer() hands out one shared no-op context manager, so instrumented code runs as before.
+    """
+
+    NULL_TIMING = contextlib.nullcontext()
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.reset()
+
+    def enable(self, enabled=True):
+        self.enabled = enabled
+
+    def reset(self):
+        self.timers = {}
+        self.counters = {}
+        self.peaks = {}
+
+    def timer(self, name):
+        """
+        Context manager that adds the time spent in it to the timer name.
+        """
+
+        if not self.enabled:
+            return self.NULL_TIMING
+
+        if name not in self.timers:
+            self.timers[name] = Timer()
+        return Timing(self.timers[name])
+
+    def add_time(self, name, seconds):
+        if self.enabled:
+            self.timers.setdefault(name, Timer()).add(seconds)
+
+    def count(self, name, n=1):
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def peak(self, name, value):
+        """
+        Records value if it is the largest seen for name, e.g. a memory use.
+        """
+
+        if self.enabled and (name not in self.peaks or value > self.peaks[name]):
+            self.peaks[name] = value
+
+    def merge(self, other):
+        """
+        Adds the metrics of other, e.g. collected by another process, to these.
+        """
+
+        for name, timer in other.timers.items():
+            self.timers.setdefault(name, Timer()).merge(timer)
+        for name, n in other.counters.items():
+            self.counters[name] = self.counters.get(name, 0) + n
+        for name, value in other.peaks.items():
+            self.peaks[name] = max(value, self.peaks.get(name, value))
+
+    def summary(self):
+        """
+        All metrics as a JSON-serializable dict; times are in seconds.
+        """
+
+        summary = {
+            'timers': {name: timer.summary() for name, timer in sorted(self.timers.items()) if timer.count},
+            'counters': dict(sorted(self.counters.items())),
+            'peaks': dict(sorted(self.peaks.items())),
+        }
+
+        if 'step' in self.timers and self.timers['step'].total > 0:
+            step = self.timers['step'].total
+            summary['rates'] = {
+                'cells_per_second': self.counters.get('cells', 0) / step,
+                'generations_per_second': self.counters.get('generations', 0) / step,
+            }
+
+        return summary
+
+    def report(self):
+        """
+        The summary as human readable lines.
+        """
+
+        summary = self.summary()
+        lines = []
+
+        for name, timer in summary['timers'].items():
+            percentiles = ' '.join(f'p{p}={timer[f"p{p}"] * 1e3:.3f}ms' for p in PERCENTILES)
+            lines.append(f'{name}: count={timer["count"]} total={timer["total"]:.3f}s mean={timer["mean"] * 1e3:.3f}ms '
+                         f'{percentiles} max={timer["max"] * 1e3:.3f}ms')
+        for name, value in {**summary['counters'], **summary['peaks'], **summary.get('rates', {})}.items():
+            lines.append(f'{name}: {value:.6g}' if isinstance(value, float) else f'{name}: {value}')
+
+        return '\n'.join(lines)
+
+class TimedLock():
+    """
+    threading.Lock that adds the time spent waiting for it to the timer name of metrics, while they are enabled.
+    """
+
+    def __init__(self, name, metrics=None):
+        self.name = name
+        self.metrics = METRICS if metrics is None else metrics
+        self.lock = threading.Lock()
+
+    def acquire(self, blocking=True, timeout=-1):
+        if not self.metrics.enabled:
+            return self.lock.acquire(blocking, timeout)
+
+        start = time.perf_counter()
+        acquired = self.lock.acquire(blocking, timeout)
+        self.metrics.add_time(self.name, time.perf_counter() - start)
+        return acquired
+
+    def release(self):
+        self.lock.release()
+
+    def locked(self):
+        return self.lock.locked()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+# metrics of this process, also enabled by setting HYPERGOL_METRICS
+METRICS = Metrics(enabled=bool(os.environ.get('HYPERGOL_METRICS')))
@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+
+import queue
+import threading
+
+from pathlib import Path
+
+import numpy as np
+
+from PIL import Image, ImageDraw
+
+from hypergol.automaton import HyperbolicAutomaton
+
+# colors of the palette entries: the state values, then the background outside the tiling and the cell edges
+PALETTE = {
+    HyperbolicAutomaton.States.DEAD: (255, 255, 255),
+    HyperbolicAutomaton.States.ALIVE: (0, 0, 255),
+    'background': (255, 255, 255),
+    'edge': (0, 0, 0),
+}
+
+# suffixes written as one animated file by Recorder, anything else is a directory of numbered PNGs
+ANIMATIONS = ('.gif', '.webp', '.png', '.apng')
+
+# generations Recorder.add() queues for the writer before it blocks until the writer catches up
+RECORD_QUEUE = 64
+
+class Renderer():
+    """
+    Headless renderer of automata on one geometry. The Poincare disk is rasterized once into a map from every pixel
+    to the cell covering it, so a frame is a single lookup of the cells' states and costs O(pixels).
+
+    Attributes
+    ----------
+    cell_map: np.ndarray[int64]
+        (size x size) array of the cell at each pixel; len(geometry) outside the tiling and len(geometry) + 1 on edges.
+    """
+
+    def __init__(self, geometry, size=512, edges=True, palette=PALETTE):
+        self.geometry = geometry
+        self.size = size
+
+        n = len(geometry)
+        self.background = n
+        self.edge = n + 1
+
+        image = Image.new('I', (size, size), self.background)
+        draw = ImageDraw.Draw(image)
+
+        # disk coordinates to pixels, y pointing up
+        polygons = geometry.polygons[:, :-1]
+        xs = (polygons.real + 1) * size / 2
+        ys = (1 - polygons.imag) * size / 2
+
+        vertices = [list(zip(x, y)) for x, y in zip(xs.tolist(), ys.tolist())]
+        for i, polygon in enumerate(vertices):
+            draw.polygon(polygon, fill=i)
+        # outlines last, so no cell covers the edges of its neighbors
+        if edges:
+            for polygon in vertices:
+                draw.polygon(polygon, outline=self.edge)
+
+        self.cell_map = np.asarray(image, dtype=np.int64)
+
+        # codes[cell] is the palette index of a cell; the state values come first, so codes[:n] are the states
+        self.codes = np.zeros(n + 2, dtype=np.uint8)
+        self.codes[self.background] = len(HyperbolicAutomaton.States)
+        self.codes[self.edge] = len(HyperbolicAutomaton.States) + 1
+
+        self.palette = np.zeros((256, 3), dtype=np.uint8)
+        for state in HyperbolicAutomaton.States:
+            self.palette[state] = palette[state]
+        self.palette[self.codes[self.background]] = palette['background']
+        self.palette[self.codes[self.edge]] = palette['edge']
+
+    def indices(self, states):
+        """
+        Returns the (size x size) array of palette indices of the frame showing states. states may belong to a grown or
+        trimmed tiling: cells the renderer does not know are left out, missing ones are shown dead.
+        """
+
+        codes = self.codes.copy()
+        n = min(len(states), self.background)
+        codes[:n] = states[:n]
+        return codes[self.cell_map]
+
+    def frame(self, states):
+        """
+        Returns the frame showing states as a (size x size x 3) RGB array.
+        """
+
+        return self.palette[self.indices(states)]
+
+    def image(self, states):
+        """
+        Returns the frame showing states as a paletted PIL image.
+        """
+
+        image = Image.fromarray(self.indices(states), mode='P')
+        image.putpalette(self.palette.tobytes())
+        return image
+
+class RenderedFrames():
+    """
+    Images of a list of states, rendered anew every time they are iterated over.
+    """
+
+    def __init__(self, renderer, states):
+        self.renderer = renderer
+        self.states = states
+
+    def __iter__(self):
+        return map(self.renderer.image, self.states)
+
+class Recorder():
+    """
+    Writes frames to path from a background thread, so that recording a generation only costs a copy of its states.
+    path is an animated .gif, .webp or .png (APNG) file, or otherwise a directory that receives a numbered PNG per
+    frame. Only every every-th added generation is recorded.
+
+    Only a directory is written frame by frame. Pillow holds every frame of an animated file in memory until the
+    recording is closed, a few hundred KiB per frame at 512 pixels (e.g. size * size bytes for a GIF), so long
+    recordings are best written to a directory.
+    """
+
+    def __init__(self, renderer, path, fps=10, every=1):
+        self.renderer = renderer
+        self.path = Path(path)
+        self.fps = fps
+        self.every = every
+
+        self.added = 0
+        self.error = None
+        self.done = False
+        self.frames = queue.Queue(maxsize=RECORD_QUEUE)
+
+        self.thread = threading.Thread(target=self._write, daemon=True)
+        self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def add(self, states):
+        if self.added % self.every == 0:
+            self.frames.put(np.array(states, dtype=np.uint8))
+        self.added += 1
+
+    def close(self):
+        """
+        Waits until every frame is written.
+        """
+
+        self.frames.put(None)
+        self.thread.join()
+
+        if self.error is not None:
+            raise RuntimeError(f'failed to record {self.path}') from self.error
+
+    def _states(self):
+        while (states := self.frames.get()) is not None:
+            yield states
+        self.done = True
+
+    def _images(self):
+        for states in self._states():
+            yield self.renderer.image(states)
+
+    def _write(self):
+        images = self._images()
+
+        try:
+            suffix = self.path.suffix.lower()
+            if suffix in ('.png', '.apng'):
+                # the APNG writer goes over the frames twice, so only their states are kept and rendered on each pass
+                states = list(self._states())
+                if states:
+                    self.renderer.image(states[0]).save(self.path, format='PNG', save_all=True,
+                                                        append_images=RenderedFrames(self.renderer, states[1:]),
+                                                        duration=1000 / self.fps, loop=0)
+            elif suffix in ANIMATIONS:
+                first = next(images, None)
+                if first is not None:
+                    first.save(self.path, save_all=True, append_images=images, duration=1000 / self.fps, loop=0)
+            else:
+                self.path.mkdir(parents=True, exist_ok=True)
+                for i, image in enumerate(images):
+                    image.save(self.path / f'{i:06d}.png')
+        except Exception as error:
+            self.error = error
+
+        # never leave add() filling a queue nobody reads
+        if not self.done:
+            for _ in self._states():
+                pass
@@ -2,12 +2,25 @@
 
 import cmd
 import threading
-import math
 import time
 
-import matplotlib.pyplot as plt
+from collections import deque
+
+import numpy as np
 import matplotlib.colors as mcolors
-from hypertiling.graphics.plot import plot_tiling, convert_polygons_to_patches
+from matplotlib.collections import PolyCollection, PathCollection
+from matplotlib.textpath import TextPath
+from matplotlib.transforms import Affine2D
+from hypertiling.graphics.plot import plot_tiling
+
+from hypergol.kernels import start_threads
+from hypergol.metrics import METRICS, TimedLock
+
+# snapshots of the automaton waiting to be drawn; only the latest is, the others are dropped
+FRAMES = 8
+
+# longest the automaton lock is held while stepping many generations, so that commands and frames never wait longer
+FRAME_TIME = 1 / 30
 
 class HypergolShell(cmd.Cmd):
     intro = 'Welcome to the hypergol shell. Type help or ? to list commands.'
@@ -16,24 +29,50 @@ class HypergolShell(cmd.Cmd):
     def __init__(self, automaton):
         super().__init__()
         self.automaton = automaton
-        self.automaton_lock = threading.Lock()
+        self.automaton_lock = TimedLock('lock_wait')
+
+        # the automaton is stepped by the command and run threads, even with the numba backend
+        start_threads()
 
         self.draw_indices = True
 
         self.ax = plot_tiling(self.automaton.tiling, dpi=250)
         self.fig = self.ax.get_figure()
-        self.texts = []
+
+        # the cells and their labels are built once per geometry; frames only recolor the cells and are blitted
+        # over a background captured at the last full draw
+        self.ax.collections[0].remove()
+        self.cells = None
+        self.labels = None
+        self.geometry = None
+        self.stale = True
+        self.background = None
+        self.fig.canvas.mpl_connect('draw_event', self._on_draw)
 
         self.dead = threading.Event()
         self.dead.set()
         self.running = threading.Event()
 
         colors = [mcolors.to_rgba('blue'), mcolors.to_rgba('white')]
-        self.color_map = {state: color for state, color in zip(self.automaton.States, colors)}
-
-        self.draw_barrier = threading.Barrier(2)
-
+        # indexed by the values of the automaton's uint8 state array
+        self.palette = np.zeros((len(self.automaton.States), 4))
+        for state, color in zip(self.automaton.States, colors):
+            self.palette[state] = color
+
+        # the simulation runs ahead of the display: stepping publishes snapshots of the states to frames, and the
+        # drawing thread shows the latest one whenever frame_ready is set
+        self.frames = deque(maxlen=FRAMES)
+        self.frames_lock = threading.Lock()
+        self.frame_ready = threading.Event()
+
+        # seconds between generations while running, 0 for as fast as possible
         self.rate = 1
+        # generations stepped at once at full speed, adapted to take about FRAME_TIME
+        self.chunk = 1
+        # (time, generation) since which the achieved speed is measured
+        self.run_start = None
+
+        self.publish()
 
     def __enter__(self):
         self.run_thread = threading.Thread(target=self._run)
@@ -44,27 +83,107 @@ class HypergolShell(cmd.Cmd):
 
     def __exit__(self, *args):
         self.run_thread.join()
-        self.draw_barrier.abort()
+
+    def _build_artists(self):
+        if self.cells is not None:
+            self.cells.remove()
+        if self.labels is not None:
+            self.labels.remove()
+            self.labels = None
+
+        self.automaton.apply_transform()
+        self.geometry = self.automaton.geometry
+        polygons = self.geometry.polygons[:, :-1]
+        vertices = np.stack((polygons.real, polygons.imag), axis=-1)
+        self.cells = PolyCollection(vertices, edgecolors='k', animated=True)
+        self.ax.add_collection(self.cells, autolim=False)
+
+        self.stale = False
+
+    def _build_labels(self):
+        # font sizes in points, shrinking towards the boundary, converted to data units
+        points = self.fig.dpi / 72 * (self.ax.get_xlim()[1] - self.ax.get_xlim()[0]) / self.ax.bbox.width
+
+        paths = []
+        for i, z in enumerate(self.automaton.geometry.polygons[:, -1].tolist()):
+            path = TextPath((0, 0), str(i), size=(15 - 13 * abs(z)) * points)
+            extents = path.get_extents()
+            paths.append(path.transformed(Affine2D().translate(z.real - (extents.x0 + extents.x1) / 2,
+                                                               z.imag - (extents.y0 + extents.y1) / 2)))
+
+        self.labels = PathCollection(paths, facecolors='k', edgecolors='none', animated=True)
+        self.ax.add_collection(self.labels, autolim=False)
+
+    def _draw_artists(self):
+        self.ax.draw_artist(self.cells)
+        if self.draw_indices:
+            self.ax.draw_artist(self.labels)
+
+    def _on_draw(self, event):
+        self.background = self.fig.canvas.copy_from_bbox(self.ax.bbox)
+        if self.cells is not None:
+            self._draw_artists()
+
+    def _publish(self):
+        # the caller holds automaton_lock
+        frame = (self.automaton.generation, self.automaton.geometry, self.automaton.states.copy())
+        with self.frames_lock:
+            if len(self.frames) == self.frames.maxlen:
+                METRICS.count('frames_dropped')
+            self.frames.append(frame)
+        self.frame_ready.set()
+
+    def publish(self):
+        '''
+        Queues the current states of the automaton to be drawn.
+        '''
+        with self.automaton_lock:
+            self._publish()
 
     def draw(self):
-        self.ax.collections[0].remove()
-        for txt in self.texts:
-            txt.remove()
-        self.texts.clear()
+        '''
+        Draws the latest published frame, if any was published since the last draw, and drops the older ones.
+        '''
+        with self.frames_lock:
+            self.frame_ready.clear()
+            if not self.frames:
+                return
+            frame = self.frames.pop()
+            METRICS.count('frames_dropped', len(self.frames))
+            self.frames.clear()
 
-        with self.automaton_lock:
-            pgons = convert_polygons_to_patches(self.automaton.tiling)
-            self.ax.add_collection(pgons)
+        with METRICS.timer('draw'):
+            self._draw(frame)
 
-            if self.draw_indices:
-                for i in self.automaton.tiling.polygons:
-                    z = self.automaton.tiling.get_center(i)
-                    dist = math.dist((0,0), (z.real, z.imag))
-                    self.texts.append(plt.text(z.real, z.imag, str(i), fontsize=15-13*dist, ha="center", va="center"))
+    def _draw(self, frame):
+        _, geometry, states = frame
 
-            self.ax.collections[-1].set_facecolor([self.color_map[state] for state in self.automaton.states])
+        # stepping an auto-expanding automaton may grow or trim its tiling
+        if geometry is not self.geometry:
+            self.stale = True
+
+        full = self.stale or self.background is None or not self.fig.canvas.supports_blit
+        if self.stale or (self.draw_indices and self.labels is None):
+            with self.automaton_lock:
+                # the artists are built from the automaton's geometry; a frame from before it changed is dropped,
+                # the change published a newer one
+                if geometry is not self.automaton.geometry:
+                    return
+                if self.stale:
+                    self._build_artists()
+                if self.draw_indices and self.labels is None:
+                    self._build_labels()
+
+        self.cells.set_facecolor(self.palette[states])
+
+        if full:
+            # _on_draw captures the new background and draws the cells over it
+            self.fig.canvas.draw()
+        else:
+            self.fig.canvas.restore_region(self.background)
+            self._draw_artists()
+            self.fig.canvas.blit(self.ax.bbox)
 
-        self.fig.canvas.draw()
         self.fig.canvas.flush_events()
 
     def do_number(self, arg):
@@ -75,7 +194,7 @@ class HypergolShell(cmd.Cmd):
             self.draw_indices = False
         else:
             self.draw_indices = not self.draw_indices
-        self.draw_barrier.wait()
+        self.publish()
 
     def do_set(self, arg):
         '''Set any number of cells by index:   set 2 3 5'''
@@ -83,7 +202,7 @@ class HypergolShell(cmd.Cmd):
         with self.automaton_lock:
             for cell in cells:
                 self.automaton.set(cell)
-        self.draw_barrier.wait()
+            self._publish()
 
     def do_kill(self, arg):
         '''Kill any number of cells by index:   kill 2 3 5'''
@@ -91,14 +210,13 @@ class HypergolShell(cmd.Cmd):
         with self.automaton_lock:
             for cell in cells:
                 self.automaton.set(cell, alive=False)
-        self.draw_barrier.wait()
+            self._publish()
 
     def do_clear(self, arg):
         '''Kill all cells:   clear'''
         with self.automaton_lock:
-            for cell in self.automaton.tiling.polygons:
-                self.automaton.set(cell, alive=False)
-        self.draw_barrier.wait()
+            self.automaton.clear()
+            self._publish()
 
     def do_toggle(self, arg):
         '''Toggle any number of cells by index:   toggle 2 3 5'''
@@ -106,7 +224,7 @@ class HypergolShell(cmd.Cmd):
         with self.automaton_lock:
             for cell in cells:
                 self.automaton.toggle(cell)
-        self.draw_barrier.wait()
+            self._publish()
 
     def do_rule(self, arg):
         '''Show current rule:   rule\nUpdate the automaton rule:   rule b 2 s 2 3'''
@@ -127,13 +245,16 @@ class HypergolShell(cmd.Cmd):
         else:
             steps = 1
 
-        for _ in range(steps):
-            with self.automaton_lock:
-                self.automaton.step()
-        self.draw_barrier.wait()
+        # many generations are stepped in chunks that release the lock and publish a frame about every FRAME_TIME
+        chunk = 1
+        while steps > 0:
+            n = min(chunk, steps)
+            chunk = self._adapt_chunk(n, self._advance(n))
+            steps -= n
 
     def do_run(self, arg):
         '''Step the cellular automaton at regular intervals, as specified by rate:   run'''
+        self.run_start = (time.perf_counter(), self.automaton.generation)
         self.running.set()
 
     def do_stop(self, arg):
@@ -141,23 +262,40 @@ class HypergolShell(cmd.Cmd):
         self.running.clear()
 
     def do_rate(self, arg):
-        '''Print the current rate:   rate\nSet the rate at which the cellular automaton steps while running:   rate 0.5'''
+        '''Print the current rate, and the achieved speed while running:   rate
+Set the seconds between generations while running:   rate 0.5
+Run as fast as possible, independently of drawing:   rate max'''
         if arg:
             rate_str = arg.split()[0]
             try:
-                rate = float(rate_str)
+                rate = 0 if rate_str == 'max' else float(rate_str)
                 assert rate >= 0
                 self.rate = rate
             except (ValueError, AssertionError):
                 print(f'invalid rate: {rate_str}')
                 return
+            self.run_start = (time.perf_counter(), self.automaton.generation)
         else:
-            print(self.rate)
+            rate = 'max' if self.rate == 0 else self.rate
+            speed = self.speed()
+            print(rate if speed is None else f'{rate} ({speed:.1f} generations/s)')
+
+    def speed(self):
+        '''
+        Generations per second achieved since running started or the rate was last set, or None when not running.
+        '''
+        if not self.running.is_set() or self.run_start is None:
+            return None
+        start, generation = self.run_start
+        elapsed = time.perf_counter() - start
+        return (self.automaton.generation - generation) / elapsed if elapsed > 0 else 0.0
 
     def do_randomize(self, arg):
         '''Randomize all cells with equal state probability:   randomize
 Randomize all cells and set probability of being alive:   randomize 0.2
-Randomize cells 0 (inclusive) through 20 (exclusive) with probability of being alive:   randomize 0.5 20'''
+Randomize cells 0 (inclusive) through 20 (exclusive) with probability of being alive:   randomize 0.5 20
+Randomize the cells of the 3 innermost layers:   randomize 0.5 layers=3
+Randomize the cells within hyperbolic distance 2.5 of the center:   randomize 0.5 radius=2.5'''
 
         args = arg.split()
 
@@ -172,27 +310,70 @@ Randomize cells 0 (inclusive) through 20 (exclusive) with probability of being a
         else:
             p_alive = 0.5
 
-        if args:
+        bounds = {'limit': None, 'layers': None, 'radius': None}
+        for bound in args:
+            name, sep, value = bound.rpartition('=')
+            name = name if sep else 'limit'
             try:
-                limit = int(args.pop(0))
-                if not limit > 0:
+                if name not in bounds:
+                    raise ValueError
+                bounds[name] = float(value) if name == 'radius' else int(value)
+                if not bounds[name] > 0:
                     raise ValueError
             except ValueError:
-                print('invalid limit')
+                print(f'invalid {name}' if name in bounds else f'invalid bound: {bound}')
                 return
+
+        with self.automaton_lock:
+            self.automaton.randomize(p_alive, **bounds)
+            self._publish()
+
+    def do_stats(self, arg):
+        '''Print timings and counters of the hot paths:   stats\nStart measuring anew:   stats reset'''
+        if not METRICS.enabled:
+            print('metrics are disabled, start hypergol with --metrics')
+        elif arg == 'reset':
+            METRICS.reset()
         else:
-            limit = None
+            print(METRICS.report())
 
+    def do_save(self, arg):
+        '''Save the automaton to a snapshot file:   save glider.hgol'''
+        if not arg:
+            print('missing path')
+            return
         with self.automaton_lock:
-            self.automaton.randomize(p_alive, limit=limit)
-        self.draw_barrier.wait()
+            try:
+                self.automaton.save(arg.strip())
+            except OSError as e:
+                print(e)
+
+    def do_load(self, arg):
+        '''Replace the automaton with one saved to a snapshot file:   load glider.hgol'''
+        if not arg:
+            print('missing path')
+            return
+        with self.automaton_lock:
+            old = self.automaton
+            try:
+                self.automaton = type(old).load(arg.strip(), backend=old.backend, incremental=old.incremental, cache=old.cache,
+                                                auto_expand=old.auto_expand, max_layers=old.max_layers)
+            except (OSError, RuntimeError) as e:
+                print(e)
+                return
+            # randomize carries on with the same random stream
+            self.automaton.rng = old.rng
+            self.stale = True
+            self.run_start = (time.perf_counter(), self.automaton.generation)
+            self._publish()
 
     def do_move(self, arg):
         '''Center the display over the cell with given index:   move 7'''
         index = next(map(int, arg.split()))
         with self.automaton_lock:
-            self.automaton.translate(index)
-        self.draw_barrier.wait()
+            self.automaton.translate(index, apply=False)
+            self.stale = True
+            self._publish()
 
     def do_exit(self, arg):
         self.dead.set()
@@ -203,25 +384,38 @@ Randomize cells 0 (inclusive) through 20 (exclusive) with probability of being a
     def do_EOF(self, arg):
         return self.do_exit(arg)
 
+    def _advance(self, generations):
+        '''
+        Steps generations at once and publishes the result. Returns the seconds spent stepping.
+        '''
+        with self.automaton_lock:
+            start = time.perf_counter()
+            self.automaton.step(generations)
+            elapsed = time.perf_counter() - start
+            self._publish()
+
+        return elapsed
+
+    @staticmethod
+    def _adapt_chunk(chunk, elapsed):
+        if elapsed < FRAME_TIME / 2:
+            return chunk * 2
+        if elapsed > FRAME_TIME and chunk > 1:
+            return chunk // 2
+        return chunk
+
     def _run(self):
         while not self.dead.is_set():
             if not self.running.wait(1):
                 continue
 
-            if self.draw_barrier.broken:
-                continue
-
-            start = time.time()
-            with self.automaton_lock:
-                self.automaton.step()
-
-            try:
-                self.draw_barrier.wait()
-            except threading.BrokenBarrierError:
+            if self.rate == 0:
+                self.chunk = self._adapt_chunk(self.chunk, self._advance(self.chunk))
                 continue
 
-            end = time.time()
+            start = time.perf_counter()
+            self._advance(1)
 
-            remaining = self.rate - (end - start)
+            remaining = self.rate - (time.perf_counter() - start)
             if remaining > 0:
                 self.dead.wait(remaining)
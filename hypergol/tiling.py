@@ -0,0 +1,343 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import math
+import shutil
+import tempfile
+import itertools
+
+from pathlib import Path
+
+import numpy as np
+import hypertiling
+
+from hypertiling import HyperbolicTiling
+from hypertiling.kernel.hyperpolygon import HyperPolygon
+from hypertiling.distance import disk_distance
+
+from hypergol.metrics import METRICS
+
+# bump whenever the files written by TilingGeometry.save change
+CACHE_FORMAT = 1
+
+# largest cosh(d) - 1, for the hyperbolic distance d, between the image of a cell center under a symmetry and the
+# center it is matched with; distinct cells are about 1 apart
+SYMMETRY_TOLERANCE = 1e-2
+
+def neighbor_index(tiling):
+    """
+    Builds a compressed sparse row (CSR) index of the neighbors of every cell.
+
+    Returns
+    -------
+    (indptr, indices): tuple of np.ndarray
+        The neighbors of cell i are indices[indptr[i]:indptr[i + 1]].
+    """
+
+    nbrs = [tiling.get_nbrs(i) for i in tiling.polygons]
+
+    indptr = np.zeros(len(nbrs) + 1, dtype=np.int64)
+    np.cumsum([len(n) for n in nbrs], out=indptr[1:])
+    indices = np.fromiter(itertools.chain.from_iterable(nbrs), dtype=np.int64, count=indptr[-1])
+
+    return indptr, indices
+
+class CenterIndex():
+    """
+    Spatial index of points in the Poincare disk that answers whether any point lies within hyperbolic distance
+    cutoff of a query point. Points are bucketed by the level floor(log2(1 - |z|^2)) and then on a square grid whose
+    spacing is proportional to 2^level, i.e. to the Euclidean size of hyperbolic balls at that distance from the origin.
+    Every query thus inspects a bounded number of points, however close to the boundary it is.
+    """
+
+    def __init__(self, points=(), cutoff=0.05, spacing=0.05):
+        self.cutoff = cutoff
+        self.spacing = spacing
+        self.tanh = math.tanh(cutoff / 2)
+        self.buckets = {}
+
+        for z in points:
+            self.add(z)
+
+    @staticmethod
+    def _level(x):
+        # floor(log2(x)) for x <= 1, exact unlike math.log2; points on or past the boundary share the lowest level
+        return math.frexp(max(x, 2 ** -1074))[1] - 1
+
+    def _key(self, z, level):
+        h = self.spacing * 2.0 ** level
+        return level, math.floor(z.real / h), math.floor(z.imag / h)
+
+    def add(self, z):
+        z = complex(z)
+        level = self._level(1 - abs(z) ** 2)
+        self.buckets.setdefault(self._key(z, level), []).append(z)
+
+    def any_within(self, z):
+        z = complex(z)
+        r2 = abs(z) ** 2
+        t2 = self.tanh ** 2
+
+        # the hyperbolic ball around z is the Euclidean disk with this center and radius
+        center = z * (1 - t2) / (1 - t2 * r2)
+        radius = self.tanh * (1 - r2) / (1 - t2 * r2)
+
+        outer = min(abs(center) + radius, 1.0)
+        inner = max(abs(center) - radius, 0.0)
+
+        # one extra level on each side absorbs rounding in the levels of the points
+        for level in range(self._level(1 - outer ** 2) - 1, self._level(1 - inner ** 2) + 2):
+            _, x0, y0 = self._key(center - complex(radius, radius), level)
+            _, x1, y1 = self._key(center + complex(radius, radius), level)
+
+            for x in range(x0, x1 + 1):
+                for y in range(y0, y1 + 1):
+                    for w in self.buckets.get((level, x, y), ()):
+                        if disk_distance(z, w) < self.cutoff:
+                            return True
+
+        return False
+
+def default_cache_dir():
+    if cache_dir := os.environ.get('HYPERGOL_CACHE_DIR'):
+        return Path(cache_dir)
+
+    return Path(os.environ.get('XDG_CACHE_HOME', Path.home() / '.cache'), 'hypergol')
+
+def cache_path(p, q, n, cache_dir=None):
+    if cache_dir is None:
+        cache_dir = default_cache_dir()
+
+    # tilings built by another hypertiling version may differ, so they are never shared
+    return Path(cache_dir, f'hypertiling-{hypertiling.__version__}', f'format-{CACHE_FORMAT}', f'{p}_{q}_{n}')
+
+class TilingGeometry():
+    """
+    Array form of a cell-centered SRG tiling: polygon coordinates, layers, exposed cells and the CSR neighbor index.
+    This is what the automaton steps on; the HyperbolicTiling itself is only built from it when needed.
+
+    Attributes
+    ----------
+    polygons: np.ndarray[complex128]
+        (cells x (p + 1)) array of the vertices of every cell followed by its center, in Poincare disk coordinates.
+    """
+
+    ARRAYS = ('polygons', 'layers', 'exposed', 'indptr', 'indices')
+
+    def __init__(self, p, q, n, polygons, layers, exposed, indptr, indices, counters):
+        self.p = p
+        self.q = q
+        self.n = n
+
+        self.polygons = polygons
+        self.layers = layers
+        self.exposed = exposed
+        self.indptr = indptr
+        self.indices = indices
+
+        # (globcount, layercount, counter) of the SRG kernel, needed to keep growing a rebuilt tiling
+        self.counters = tuple(counters)
+
+        self._symmetries = None
+
+    def __len__(self):
+        return len(self.polygons)
+
+    @classmethod
+    def from_tiling(cls, tiling):
+        """
+        Extracts the geometry of tiling. The polygons of tiling are rebound to rows of the returned coordinate array,
+        so that moving the tiling also moves the geometry.
+        """
+
+        polygons = np.array([poly.get_polygon() for poly in tiling.polygons.values()], dtype=np.complex128)
+        polygons = polygons.reshape(len(tiling.polygons), tiling.p + 1)
+
+        for row, poly in zip(polygons, tiling.polygons.values()):
+            poly.set_polygon(row)
+
+        layers = np.array([poly.layer for poly in tiling.polygons.values()], dtype=np.int64)
+        exposed = np.array(tiling.exposed, dtype=np.int64)
+        indptr, indices = neighbor_index(tiling)
+
+        return cls(tiling.p, tiling.q, tiling.n, polygons, layers, exposed, indptr, indices,
+                   (tiling.globcount, tiling.layercount, tiling.counter))
+
+    def build_tiling(self):
+        """
+        Builds the SRG HyperbolicTiling described by this geometry. Its polygons are views into self.polygons.
+        """
+
+        # a single layer is cheap to construct and initializes everything but the cells themselves
+        tiling = HyperbolicTiling(self.p, self.q, 1, kernel='SRG')
+        tiling.n = self.n
+
+        tiling.polygons = {}
+        tiling.nbrs = {}
+        tiling._prepare_duplicate_container()
+
+        for i, (vertices, layer) in enumerate(zip(self.polygons, self.layers.tolist())):
+            poly = HyperPolygon(self.p, vertices=vertices, idx=i, layer=layer)
+            tiling.polygons[i] = poly
+            tiling.nbrs[i] = self.indices[self.indptr[i]:self.indptr[i + 1]].tolist()
+            tiling.dplcts.add(poly.get_center(), i)
+
+        tiling.fund_poly = tiling.polygons[0]
+        tiling.exposed = self.exposed.tolist()
+        tiling.globcount, tiling.layercount, tiling.counter = self.counters
+
+        return tiling
+
+    def _match(self, images):
+        """
+        Returns the cell whose center is images[i] for every cell i, or None if some image is not a cell center.
+        Cells are searched among those of the same layer at about the same angle.
+        """
+
+        centers = self.polygons[:, -1]
+        size = len(centers)
+
+        # layers sort apart, and every angle also appears one turn lower and higher so that no search wraps around
+        key = self.layers * 20.0 + np.angle(centers)
+        keys = np.concatenate((key - 2 * np.pi, key, key + 2 * np.pi))
+        order = np.argsort(keys, kind='stable')
+        keys = keys[order]
+        cells = order % size
+
+        positions = np.searchsorted(keys, self.layers * 20.0 + np.angle(images))
+        candidates = cells[np.clip(positions[:, None] + np.arange(-4, 4), 0, len(keys) - 1)]
+        match = candidates[np.arange(size), np.abs(centers[candidates] - images[:, None]).argmin(axis=1)]
+
+        z, w = centers[match], images
+        distance = 2 * np.abs(z - w) ** 2 / ((1 - np.abs(z) ** 2) * (1 - np.abs(w) ** 2))
+        if (distance > SYMMETRY_TOLERANCE).any():
+            return None
+
+        return match
+
+    def _is_automorphism(self, permutation):
+        size = len(permutation)
+        if len(np.unique(permutation)) != size or (self.layers[permutation] != self.layers).any():
+            return False
+
+        cells = np.repeat(np.arange(size), np.diff(self.indptr))
+        edges = np.sort(cells * size + self.indices)
+        images = np.sort(permutation[cells] * size + permutation[self.indices])
+
+        return bool((edges == images).all())
+
+    def symmetries(self):
+        """
+        The rotations and reflections about the center of cell 0 that map the tiling onto itself, as permutations:
+        cell i is mapped to cell permutation[i]. Only those preserving every neighbor list are kept, so they commute
+        with stepping; they are computed once, from the coordinates at the first call.
+
+        Returns
+        -------
+        symmetries: dict of str to np.ndarray
+            'ROTATION' maps to the p - 1 nontrivial rotations, 'REFLECTION' to the p reflections, as rows of an
+            array that is empty if any of them was not a symmetry.
+        """
+
+        if self._symmetries is not None:
+            return self._symmetries
+
+        centers = self.polygons[:, -1] - self.polygons[0, -1]
+        # reflection axes pass through the vertices and edge midpoints of cell 0
+        axis = np.angle(self.polygons[0, 0] - self.polygons[0, -1])
+
+        transforms = {
+            'ROTATION': [centers * np.exp(2j * np.pi * k / self.p) for k in range(1, self.p)],
+            'REFLECTION': [np.exp(2j * (axis + np.pi * k / self.p)) * np.conj(centers) for k in range(self.p)],
+        }
+
+        self._symmetries = {}
+        for kind, images in transforms.items():
+            permutations = [self._match(z + self.polygons[0, -1]) for z in images]
+            if any(permutation is None or not self._is_automorphism(permutation) for permutation in permutations):
+                permutations = []
+            self._symmetries[kind] = np.array(permutations, dtype=np.int64).reshape(len(permutations), len(self))
+
+        return self._symmetries
+
+    def truncate(self, layers):
+        """
+        Returns the geometry of the cells in the innermost layers layers. Cells must be ordered by layer, as they are
+        in tilings grown with the SRG kernel, and growing the truncated geometry again adds the same cells back.
+        """
+
+        size = int(np.searchsorted(self.layers, layers))
+        first = int(np.searchsorted(self.layers, layers - 1))
+
+        # neighbor lists lose the removed cells
+        indptr = self.indptr[:size + 1]
+        indices = self.indices[:indptr[-1]]
+        keep = indices < size
+        kept = np.zeros(len(keep) + 1, dtype=np.int64)
+        np.cumsum(keep, out=kept[1:])
+
+        return TilingGeometry(self.p, self.q, self.n, self.polygons[:size].copy(), self.layers[:size].copy(),
+                              np.arange(first, size, dtype=np.int64), kept[indptr], indices[keep],
+                              (size, layers - 1, first))
+
+    def save(self, path):
+        """
+        Writes the geometry to the directory path as one .npy file per array, which can be memory mapped by load().
+        The directory is created atomically, so concurrent writers of the same geometry are harmless.
+        """
+
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+
+        tmp = Path(tempfile.mkdtemp(prefix=f'.{path.name}-', dir=path.parent))
+        try:
+            for name in self.ARRAYS:
+                np.save(tmp / f'{name}.npy', getattr(self, name))
+
+            meta = {'p': self.p, 'q': self.q, 'n': self.n, 'counters': self.counters}
+            (tmp / 'meta.json').write_text(json.dumps(meta))
+
+            os.rename(tmp, path)
+        except OSError:
+            # another process already stored this geometry
+            if not path.is_dir():
+                raise
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Memory maps a geometry written by save(). The arrays are copy-on-write: modifying them never touches the files.
+        """
+
+        path = Path(path)
+        meta = json.loads((path / 'meta.json').read_text())
+        arrays = {name: np.asarray(np.load(path / f'{name}.npy', mmap_mode='c')) for name in cls.ARRAYS}
+
+        return cls(meta['p'], meta['q'], meta['n'], counters=meta['counters'], **arrays)
+
+def load_geometry(p, q, n, cache=True, cache_dir=None):
+    """
+    Returns the TilingGeometry of the {p, q} tiling with n layers, from the tiling cache if possible.
+    Freshly built geometries are stored in the cache unless cache is False.
+    """
+
+    if not cache:
+        with METRICS.timer('tiling_build'):
+            return TilingGeometry.from_tiling(HyperbolicTiling(p, q, n, kernel='SRG'))
+
+    path = cache_path(p, q, n, cache_dir)
+
+    try:
+        with METRICS.timer('tiling_load'):
+            return TilingGeometry.load(path)
+    except (OSError, ValueError, KeyError):
+        pass
+
+    with METRICS.timer('tiling_build'):
+        geometry = TilingGeometry.from_tiling(HyperbolicTiling(p, q, n, kernel='SRG'))
+    geometry.save(path)
+
+    return geometry
@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+
+import argparse
+import sqlite3
+import json
+import zlib
+import sys
+import os
+
+from pathlib import Path
+
+from hypergol.automaton import parse_rule, format_rule
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    p INTEGER NOT NULL,
+    q INTEGER NOT NULL,
+    layers INTEGER NOT NULL,
+    rule TEXT NOT NULL,
+    seed TEXT,
+    init_prob REAL,
+    init_limit INTEGER,
+    max_steps INTEGER,
+    config TEXT NOT NULL,
+    reason TEXT NOT NULL,
+    termination TEXT NOT NULL,
+    period INTEGER,
+    generations INTEGER NOT NULL,
+    stats TEXT NOT NULL,
+    trace BLOB
+);
+CREATE INDEX IF NOT EXISTS runs_by_geometry ON runs (p, q, reason, period);
+CREATE INDEX IF NOT EXISTS runs_by_rule ON runs (rule);
+CREATE UNIQUE INDEX IF NOT EXISTS runs_by_config ON runs (config);
+'''
+
+def canonical_rule(rule_str):
+    return format_rule(*map(sorted, parse_rule(rule_str)))
+
+def termination_reason(termination):
+    """
+    Category of a termination message, e.g. 'PERIODIC' for 'PERIODIC. REVISITED GENERATION 4. PERIOD=2'.
+    """
+
+    return termination.split('.')[0]
+
+class ResultStore():
+    """
+    SQLite database of search results, one row per run. Several processes may write to the same database;
+    each call to add() is one transaction. A run is identified by its full config, which includes the seed, and
+    storing it again (e.g. a batch rerun by a resumed campaign) is a no-op.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.connection = sqlite3.connect(self.path, timeout=60)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+
+        try:
+            self.connection.executescript(SCHEMA)
+        except sqlite3.IntegrityError:
+            # databases from before runs were unique may hold some twice; the first copy is kept
+            with self.connection:
+                self.connection.execute('DELETE FROM runs WHERE id NOT IN (SELECT MIN(id) FROM runs GROUP BY config)')
+            self.connection.executescript(SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.connection.close()
+
+    def add(self, results, traces=None):
+        """
+        Stores the Search.result() dicts in results. traces optionally holds the text output of each run,
+        which is stored compressed.
+        """
+
+        if traces is None:
+            traces = [None] * len(results)
+
+        rows = []
+        for result, trace in zip(results, traces):
+            config = result['config']
+            rows.append((
+                config['p'],
+                config['q'],
+                config['layers'],
+                canonical_rule(config['rule']),
+                None if config['seed'] is None else str(config['seed']),
+                config['init_prob'],
+                config['init_limit'],
+                config['max_steps'],
+                json.dumps(config),
+                termination_reason(result['termination']),
+                result['termination'],
+                result['period'],
+                result['generations'],
+                json.dumps(result['stats']),
+                None if trace is None else zlib.compress(trace.encode()),
+            ))
+
+        with self.connection:
+            self.connection.executemany('''
+                INSERT OR IGNORE INTO runs (p, q, layers, rule, seed, init_prob, init_limit, max_steps, config, reason, termination,
+                                  period, generations, stats, trace)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', rows)
+
+    def query(self, p=None, q=None, layers=None, rule=None, reason=None, min_period=None, max_period=None, limit=None):
+        """
+        Yields (id, config, termination, period, generations, stats) of every matching run.
+        """
+
+        conditions = []
+        params = []
+
+        if rule is not None:
+            rule = canonical_rule(rule)
+
+        for column, value in (('p', p), ('q', q), ('layers', layers), ('rule', rule), ('reason', reason)):
+            if value is not None:
+                conditions.append(f'{column} = ?')
+                params.append(value)
+
+        if min_period is not None:
+            conditions.append('period >= ?')
+            params.append(min_period)
+
+        if max_period is not None:
+            conditions.append('period <= ?')
+            params.append(max_period)
+
+        sql = 'SELECT id, config, termination, period, generations, stats FROM runs'
+        if conditions:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+        sql += ' ORDER BY id'
+        if limit is not None:
+            sql += ' LIMIT ?'
+            params.append(limit)
+
+        for run_id, config, termination, period, generations, stats in self.connection.execute(sql, params):
+            yield run_id, json.loads(config), termination, period, generations, json.loads(stats)
+
+    def trace(self, run_id):
+        row = self.connection.execute('SELECT trace FROM runs WHERE id = ?', (run_id,)).fetchone()
+
+        if row is None:
+            raise RuntimeError(f'no run with id {run_id}')
+        if row[0] is None:
+            raise RuntimeError(f'no trace was stored for run {run_id}')
+
+        return zlib.decompress(row[0]).decode()
+
+def main():
+    parser = argparse.ArgumentParser(description='query a database of search results')
+    parser.add_argument('database', type=Path)
+    parser.add_argument('-p', help='number of sides to a polygon', type=int)
+    parser.add_argument('-q', help='number of polygons around a vertex', type=int)
+    parser.add_argument('-l', '--layers', type=int)
+    parser.add_argument('--rule', help='format: b[0-9 ]+s[0-9 ]+', type=str)
+    parser.add_argument('--reason', help='exact termination reason, one of PERIODIC, PERIODIC MOD ROTATION, PERIODIC MOD REFLECTION, STATIC, '
+                        'ALL STATES EQUAL DEAD, ALL STATES EQUAL ALIVE, MAX STEPS REACHED, PLATEAU, DECAY, NOISE', type=str)
+    parser.add_argument('--min-period', type=int)
+    parser.add_argument('--max-period', type=int)
+    parser.add_argument('--limit', help='maximum number of runs to print', type=int)
+    parser.add_argument('-c', '--count', help='only print the number of matching runs', action='store_true')
+    parser.add_argument('--stats', help='also print the population statistics of each run', action='store_true')
+    parser.add_argument('--trace', help='print the stored output of the run with this id', type=int, metavar='ID')
+
+    args = parser.parse_args()
+
+    if not args.database.exists():
+        raise RuntimeError(f'no such database: {args.database}')
+
+    with ResultStore(args.database) as store:
+        if args.trace is not None:
+            print(store.trace(args.trace), end='')
+            return
+
+        runs = store.query(p=args.p, q=args.q, layers=args.layers, rule=args.rule, reason=args.reason,
+                           min_period=args.min_period, max_period=args.max_period, limit=args.limit)
+
+        if args.count:
+            print(sum(1 for _ in runs))
+            return
+
+        for run_id, config, termination, period, generations, stats in runs:
+            print(f'{run_id}\t{json.dumps(config)}\t{termination}\tGENERATIONS={generations}')
+            if args.stats:
+                for name, value in stats.items():
+                    print(f'\t{name}={value}')
+
+if __name__ == '__main__':
+    try:
+        main()
+    except BrokenPipeError:
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(devnull, sys.stdout.fileno())
+        sys.exit(1)
@@ -1,38 +1,59 @@
 #!/usr/bin/env python3
 
 import argparse
-import random
+import io
 import time
 import json
 import sys
 import os
 import itertools
-import statistics
+import math
+import hashlib
+import functools
 
-from collections import defaultdict
+from collections import defaultdict, OrderedDict, deque
 from pathlib import Path
 
-from hypergol.automaton import HyperbolicAutomaton
+import numpy as np
+
+from hypergol.automaton import HyperbolicAutomaton, random_states
+from hypergol.batch import BatchedAutomaton
+from hypergol.kernels import BACKENDS
+from hypergol.metrics import METRICS
+from hypergol.render import Renderer, Recorder
 
 class AutomatonState():
-    def __init__(self, state, states_enum):
-        self.state = state
-        self.state_hash = hash(tuple(self.state))
+    def __init__(self, state, states_enum, population=None):
+        # snapshot the raw state bytes; self.state is a read-only view over them
+        state_bytes = state.tobytes()
+        self.state = np.frombuffer(state_bytes, dtype=np.uint8)
         self.size = len(state)
 
         self.states_enum = states_enum
 
-        self.counts = {s: self.state.count(s) for s in self.states_enum}
+        # the stepping engine already knows the population, which saves counting the cells again
+        if population is None:
+            population = int(np.count_nonzero(self.state))
+        self.counts = {s: population if s == s.ALIVE else self.size - population for s in self.states_enum}
+
+        # trailing dead cells are not part of a generation's identity, so that generations of an auto-expanding
+        # automaton compare equal however far its tiling had grown
+        end = self.size - int(np.argmax(self.state[::-1])) if population else 0
+        self.state_bytes = state_bytes if end == self.size else state_bytes[:end]
+        self.state_hash = hash(self.state_bytes)
 
     def all_equal(self):
-        return all(s == self.state[0] for s in self.state)
+        return bool((self.state == self.state[0]).all())
+
+    def first(self):
+        return self.states_enum(self.state[0])
 
     def summary(self):
         return ' '.join(f'{count}({count / self.size:0.3f}) {state.name}' for state, count in self.counts.items())
 
     def __eq__(self, other):
         if type(other) == AutomatonState:
-            return self.state_hash == other.state_hash and self.state == other.state
+            return self.state_hash == other.state_hash and self.state_bytes == other.state_bytes
         return False
 
     def __ne__(self, other):
@@ -41,14 +62,349 @@ class AutomatonState():
     def __hash__(self):
         return self.state_hash
 
+    @functools.cached_property
+    def packed(self):
+        return np.packbits(np.frombuffer(self.state_bytes, dtype=np.uint8)).tobytes()
+
+    @functools.cached_property
+    def fingerprint(self):
+        return hashlib.blake2b(self.packed, digest_size=16).digest()
+
+def sqrt_fraction(n, m):
+    """
+    Correctly rounded square root of the non-negative fraction n / m.
+    """
+
+    # take an integer square root with a few more bits than a float holds, rounded to odd so that converting it
+    # to a float rounds correctly
+    q = (n.bit_length() - m.bit_length() - 2 * sys.float_info.mant_dig - 3) // 2
+    if q >= 0:
+        m <<= 2 * q
+    else:
+        n <<= -2 * q
+
+    root = math.isqrt(n // m)
+    root |= root * root * m != n
+
+    return root * 2.0 ** q if q >= 0 else root / (1 << -q)
+
+class RunningStats():
+    """
+    Online accumulator of the minimum, maximum and sample standard deviation of a stream of integers.
+    The sums are exact integers, so the result does not drift however long the stream is.
+    """
+
+    def __init__(self):
+        self.n = 0
+        self.total = 0
+        self.total_sq = 0
+        self.min = None
+        self.max = None
+
+    def push(self, x):
+        self.n += 1
+        self.total += x
+        self.total_sq += x * x
+
+        if self.min is None or x < self.min:
+            self.min = x
+        if self.max is None or x > self.max:
+            self.max = x
+
+    def stdev(self):
+        if self.n < 2:
+            raise ValueError('stdev requires at least two data points')
+
+        return sqrt_fraction(self.n * self.total_sq - self.total ** 2, self.n * (self.n - 1))
+
+class FullHistory():
+    """
+    Remembers every generation's full state. Memory grows with both the tiling and the number of generations.
+    """
+
+    def __init__(self):
+        self.state_to_generation = {}
+
+    def lookup(self, automaton_state):
+        return self.state_to_generation.get(automaton_state)
+
+    def add(self, automaton_state, generation):
+        self.state_to_generation[automaton_state] = generation
+
+    def nbytes(self):
+        return sys.getsizeof(self.state_to_generation) + sum(s.state.nbytes for s in self.state_to_generation)
+
+class FingerprintHistory():
+    """
+    Remembers a 128-bit fingerprint of every generation's packed state, so memory does not depend on the tiling.
+    The packed states of the last window generations are kept as well, to confirm a fingerprint match against them.
+    A match with an older generation is reported on the fingerprint alone, so a cycle longer than window
+    generations is only as certain as the hash: two distinct states collide with probability about 2**-128.
+    """
+
+    def __init__(self, window=64):
+        self.window = window
+        self.fingerprint_to_generation = {}
+        self.recent = OrderedDict()
+
+    def lookup(self, automaton_state):
+        generation = self.fingerprint_to_generation.get(automaton_state.fingerprint)
+
+        if generation in self.recent and self.recent[generation] != automaton_state.packed:
+            # fingerprint collision
+            return None
+
+        return generation
+
+    def add(self, automaton_state, generation):
+        self.fingerprint_to_generation[automaton_state.fingerprint] = generation
+
+        self.recent[generation] = automaton_state.packed
+        if len(self.recent) > self.window:
+            self.recent.popitem(last=False)
+
+    def nbytes(self):
+        return (sys.getsizeof(self.fingerprint_to_generation) + sum(map(sys.getsizeof, self.fingerprint_to_generation))
+                + sys.getsizeof(self.recent) + sum(map(sys.getsizeof, self.recent.values())))
+
+class BoundedHistory():
+    """
+    Uses memory independent of the number of generations. Cycles with a period of at most window generations are
+    found at their first repetition from the fingerprints of the last window generations. Longer cycles are found by
+    Brent's algorithm, which compares against a single checkpointed state that moves to the current generation
+    whenever the distance to it reaches the next power of two. Those are only reported once the checkpoint lies on
+    the cycle: a cycle entered at generation mu with period lam is found at generation 2**k - 1 + lam, with 2**k the
+    least power of two of at least max(mu + 1, lam). That is before generation 3 * (mu + lam), but may be long after
+    its first repetition at mu + lam, so a search that the other histories end as PERIODIC may reach its max steps
+    first, and the revisited generation is that of the checkpoint.
+    """
+
+    def __init__(self, window=64):
+        self.window = window
+        self.fingerprint_to_generation = {}
+        self.recent = OrderedDict()
+
+        self.checkpoint = None
+        self.checkpoint_generation = None
+        self.power = 1
+
+    def lookup(self, automaton_state):
+        generation = self.fingerprint_to_generation.get(automaton_state.fingerprint)
+        if generation is not None:
+            return generation
+
+        if self.checkpoint == automaton_state.packed:
+            return self.checkpoint_generation
+
+        return None
+
+    def add(self, automaton_state, generation):
+        fingerprint = automaton_state.fingerprint
+
+        self.fingerprint_to_generation[fingerprint] = generation
+        self.recent[generation] = fingerprint
+        if len(self.recent) > self.window:
+            old_generation, old_fingerprint = self.recent.popitem(last=False)
+            if self.fingerprint_to_generation.get(old_fingerprint) == old_generation:
+                del self.fingerprint_to_generation[old_fingerprint]
+
+        if self.checkpoint is None or generation - self.checkpoint_generation >= self.power:
+            if self.checkpoint is not None:
+                self.power *= 2
+            self.checkpoint = automaton_state.packed
+            self.checkpoint_generation = generation
+
+    def nbytes(self):
+        # the fingerprints of recent are the keys of fingerprint_to_generation
+        return (sys.getsizeof(self.fingerprint_to_generation) + sum(map(sys.getsizeof, self.fingerprint_to_generation))
+                + sys.getsizeof(self.recent) + sys.getsizeof(self.checkpoint))
+
+HISTORIES = {
+    'full': FullHistory,
+    'fingerprint': FingerprintHistory,
+    'bounded': BoundedHistory,
+}
+
+# early-stop detectors watch the population of every generation and the number of cells that changed to reach it.
+# update() returns the reason to stop the search, or None. Sums are kept as integers, so the verdicts are exact
+
+def check_window(window):
+    if not isinstance(window, int) or window < 1:
+        raise ValueError(f'window={window}')
+
+def check_fraction(name, value):
+    if not 0 <= value <= 1:
+        raise ValueError(f'{name}={value}')
+
+class DensityPlateau():
+    """
+    Stops once the mean density of the last window generations differs from that of the window before it by at most
+    tolerance.
+    """
+
+    def __init__(self, window=128, tolerance=0.005):
+        check_window(window)
+        check_fraction('tolerance', tolerance)
+
+        self.window = window
+        self.tolerance = tolerance
+        self.populations = deque(maxlen=2 * window)
+        self.older = 0
+        self.newer = 0
+
+    def update(self, population, changed, size):
+        if len(self.populations) == 2 * self.window:
+            self.older -= self.populations[0]
+        if len(self.populations) >= self.window:
+            moved = self.populations[-self.window]
+            self.older += moved
+            self.newer -= moved
+
+        self.populations.append(population)
+        self.newer += population
+
+        if len(self.populations) == 2 * self.window and abs(self.newer - self.older) <= self.tolerance * self.window * size:
+            return f'PLATEAU. MEAN DENSITY CHANGED BY AT MOST {self.tolerance} OVER {self.window} GENERATIONS'
+
+        return None
+
+class MonotoneDecay():
+    """
+    Stops once the population has not grown for window generations, over which it fell by at least a fraction of drop.
+    """
+
+    def __init__(self, window=128, drop=0.5):
+        check_window(window)
+        check_fraction('drop', drop)
+
+        self.window = window
+        self.drop = drop
+        self.populations = deque(maxlen=window + 1)
+        self.streak = 0
+
+    def update(self, population, changed, size):
+        # number of generations since the population last grew
+        if self.populations:
+            self.streak = 0 if population > self.populations[-1] else self.streak + 1
+
+        self.populations.append(population)
+
+        if self.streak >= self.window and population <= (1 - self.drop) * self.populations[0]:
+            return f'DECAY. POPULATION FELL BY AT LEAST {self.drop} WITHOUT GROWING FOR {self.window} GENERATIONS'
+
+        return None
+
+class NoiseSaturation():
+    """
+    Stops once, over the last window generations, the mean density lies within tolerance of density and on average
+    at least a fraction of churn of the cells changed every generation.
+    """
+
+    def __init__(self, window=128, density=0.5, tolerance=0.05, churn=0.1):
+        check_window(window)
+        for name, value in (('density', density), ('tolerance', tolerance), ('churn', churn)):
+            check_fraction(name, value)
+
+        self.window = window
+        self.density = density
+        self.tolerance = tolerance
+        self.churn = churn
+        self.recent = deque(maxlen=window)
+        self.population_sum = 0
+        self.changed_sum = 0
+
+    def update(self, population, changed, size):
+        if len(self.recent) == self.window:
+            old_population, old_changed = self.recent[0]
+            self.population_sum -= old_population
+            self.changed_sum -= old_changed
+
+        self.recent.append((population, changed))
+        self.population_sum += population
+        self.changed_sum += changed
+
+        if len(self.recent) < self.window:
+            return None
+
+        cells = self.window * size
+        if abs(self.population_sum - self.density * cells) <= self.tolerance * cells and self.changed_sum >= self.churn * cells:
+            return f'NOISE. MEAN DENSITY WITHIN {self.tolerance} OF {self.density} AND CHURN AT LEAST {self.churn} OVER {self.window} GENERATIONS'
+
+        return None
+
+DETECTORS = {
+    'plateau': DensityPlateau,
+    'decay': MonotoneDecay,
+    'noise': NoiseSaturation,
+}
+
+def parse_detector(spec):
+    """
+    Builds an early-stop detector from a spec of the format name[:option=value[,option=value...]], e.g. 'decay:drop=0.9'.
+    Windows must be positive integers, fractions and tolerances lie in [0, 1].
+    """
+
+    name, _, options_str = spec.partition(':')
+
+    if name not in DETECTORS:
+        raise RuntimeError(f'invalid early-stop detector: {name}. choose from {", ".join(DETECTORS)}')
+
+    options = {}
+    for option in filter(None, options_str.split(',')):
+        key, sep, value = option.partition('=')
+        try:
+            if not sep:
+                raise ValueError
+            options[key] = int(value) if value.isdigit() else float(value)
+        except ValueError:
+            raise RuntimeError(f'invalid early-stop option: {option}')
+
+    try:
+        return DETECTORS[name](**options)
+    except TypeError:
+        raise RuntimeError(f'invalid early-stop options for {name}: {options_str}')
+    except ValueError as e:
+        raise RuntimeError(f'invalid early-stop option: {e}')
+
 class Search():
-    def __init__(self, rule, p, q, layers, seed, max_steps=None, file=None, init_prob=None, init_limit=None):
+    # attributes saved by checkpoint(), besides the automaton's states and the output
+    CHECKPOINTED = ('current_generation', 'termination', 'period', 'states', 'history', 'symmetric_histories', 'count_stats',
+                    'diff_stats', 'previous_counts', 'detectors')
+
+    # kinds of symmetries that generations are compared up to, see TilingGeometry.symmetries
+    SYMMETRIES = ('ROTATION', 'REFLECTION')
+
+    def __init__(self, rule, p, q, layers, seed, max_steps=None, file=None, init_prob=None, init_limit=None, backend='auto', incremental=False,
+                 cache=True, history='fingerprint', automaton=None, early_stop=None, recorder=None, auto_expand=False, max_layers=None,
+                 metrics=False, symmetry=False, snapshot=None, init_layers=None, init_radius=None):
+        # the initial state is drawn from a numpy Generator seeded with seed alone, so runs in parallel never share a stream
         self.seed = seed
-        random.seed(self.seed)
 
         self.init_prob = init_prob
         self.init_limit = init_limit
-        self.automaton = HyperbolicAutomaton(rule, p, q, layers, init_prob=init_prob, init_limit=init_limit)
+        self.init_layers = init_layers
+        self.init_radius = init_radius
+
+        self.auto_expand = auto_expand
+        self.max_layers = max_layers
+
+        # path of the snapshot the search continues from, if any. p and q are then only checked against it, and rule
+        # replaces its rule unless None
+        self.snapshot = snapshot
+
+        # an already initialized automaton (e.g. a Universe of a BatchedAutomaton) may be passed instead
+        if automaton is None and snapshot is not None:
+            automaton = HyperbolicAutomaton.load(snapshot, backend=backend, incremental=incremental, cache=cache,
+                                                 auto_expand=auto_expand, max_layers=max_layers)
+            if p is not None and (p, q) != (automaton.geometry.p, automaton.geometry.q):
+                raise RuntimeError(f'the snapshot is of the {{{automaton.geometry.p}, {automaton.geometry.q}}} tiling')
+            if rule is not None:
+                automaton.set_rule(rule)
+        elif automaton is None:
+            automaton = HyperbolicAutomaton(rule, p, q, layers, init_prob=init_prob, init_limit=init_limit, backend=backend,
+                                            incremental=incremental, cache=cache, auto_expand=auto_expand, max_layers=max_layers,
+                                            seed=seed, init_layers=init_layers, init_radius=init_radius)
+        self.automaton = automaton
 
         if file is None:
             self.file = sys.stdout
@@ -60,103 +416,424 @@ class Search():
         else:
             self.max_steps = max_steps
 
-        self.current_generation = 0
+        # generations are numbered on from the snapshot's
+        self.current_generation = 0 if snapshot is None else self.automaton.generation
 
+        # set once the search terminates; period only for static and periodic automata
+        self.termination = None
+        self.period = None
+
+        # all AutomatonStates are only kept with the full history
+        self.keep_states = history == 'full'
         self.states = []
-        self.state_to_generation = {}
+        self.history = HISTORIES[history]()
 
-    def print_config(self):
-        config_dict = {
+        # with symmetry, generations are also remembered by their canonical form up to rotation and up to rotation and
+        # reflection, so that a pattern turning into a rotated or reflected copy of itself ends the search
+        self.symmetry = symmetry
+        self.symmetric_histories = {kind: HISTORIES[history]() for kind in self.SYMMETRIES} if symmetry else {}
+
+        # population statistics, accumulated as the generations pass
+        self.count_stats = {s: RunningStats() for s in self.automaton.States}
+        self.diff_stats = {s: RunningStats() for s in self.automaton.States}
+        self.previous_counts = None
+
+        # specs of the early-stop detectors, see parse_detector
+        self.early_stop = list(early_stop or ())
+        self.detectors = [parse_detector(spec) for spec in self.early_stop]
+
+        # a hypergol.render.Recorder that receives every generation
+        self.recorder = recorder
+
+        # whether the prologue ends with the metrics of this process as a line of JSON
+        self.metrics = metrics
+
+    def config(self):
+        config = {
             'rule': self.automaton.get_rule(),
-            'p': self.automaton.tiling.p,
-            'q': self.automaton.tiling.q,
-            'layers': self.automaton.tiling.n,
+            'p': self.automaton.geometry.p,
+            'q': self.automaton.geometry.q,
+            'layers': self.automaton.geometry.n,
             'max_steps': self.max_steps,
             'seed': self.seed,
             'init_prob': self.init_prob,
             'init_limit': self.init_limit
         }
 
-        print(json.dumps(config_dict), file=self.file)
+        if self.init_layers is not None:
+            config['init_layers'] = self.init_layers
+
+        if self.init_radius is not None:
+            config['init_radius'] = self.init_radius
+
+        if self.early_stop:
+            config['early_stop'] = self.early_stop
+
+        if self.auto_expand:
+            config['auto_expand'] = True
+            config['max_layers'] = self.automaton.max_layers
+
+        if self.symmetry:
+            config['symmetry'] = True
+
+        if self.snapshot is not None:
+            config['snapshot'] = str(self.snapshot)
+
+        return config
+
+    def stats(self):
+        """
+        Population statistics of the generations so far, keyed as in the prologue, e.g. 'ALIVE MAX_COUNT'.
+        """
+
+        stats = {}
+
+        for state_type in self.automaton.States:
+            counts = self.count_stats[state_type]
+            stats[f'{state_type.name} MAX_COUNT'] = counts.max
+            stats[f'{state_type.name} MIN_COUNT'] = counts.min
+            stats[f'{state_type.name} RANGE_COUNT'] = counts.max - counts.min
+
+            if counts.n > 1:
+                stats[f'{state_type.name} STDEV_COUNT'] = counts.stdev()
+
+                diffs = self.diff_stats[state_type]
+                stats[f'{state_type.name} MAX_DIFF'] = diffs.max
+                stats[f'{state_type.name} MIN_DIFF'] = diffs.min
+                stats[f'{state_type.name} RANGE_DIFF'] = diffs.max - diffs.min
+
+                if diffs.n > 1:
+                    stats[f'{state_type.name} STDEV_DIFF'] = diffs.stdev()
+
+        return stats
+
+    def result(self):
+        """
+        Summary of a terminated search, as stored in a results database.
+        """
+
+        return {
+            'config': self.config(),
+            'termination': self.termination,
+            'period': self.period,
+            'generations': self.current_generation,
+            'stats': self.stats(),
+        }
+
+    def checkpoint(self):
+        """
+        Everything needed to continue the search later with restore(), including how much output it has written.
+        The checkpoint shares objects with the search, so it must be serialized (e.g. pickled) before stepping on.
+        """
+
+        checkpoint = {name: getattr(self, name) for name in self.CHECKPOINTED}
+        checkpoint['automaton_states'] = None if self.termination is not None else np.array(self.automaton.states)
+
+        if isinstance(self.file, io.StringIO):
+            checkpoint['output'] = self.file.getvalue()
+        elif self.discards_output():
+            checkpoint['output'] = None
+        else:
+            self.file.flush()
+            checkpoint['output'] = self.file.tell()
+
+        return checkpoint
+
+    def discards_output(self):
+        """
+        Whether the output has no position to return to, e.g. os.devnull or a pipe.
+        """
+
+        return not self.file.seekable() or getattr(self.file, 'name', None) == os.devnull
+
+    def restore(self, checkpoint):
+        """
+        Continues from a checkpoint of a search with the same configuration. self.file must hold the output written
+        before the checkpoint: it is truncated to the checkpointed position, or the output is written to it in full
+        if the file is an io.StringIO. Discarded output is left alone.
+        """
+
+        for name in self.CHECKPOINTED:
+            setattr(self, name, checkpoint[name])
+
+        if checkpoint['automaton_states'] is not None:
+            self.automaton.set_states(checkpoint['automaton_states'])
+
+        if isinstance(checkpoint['output'], str):
+            self.file.write(checkpoint['output'])
+        elif checkpoint['output'] is not None and not self.discards_output():
+            self.file.seek(checkpoint['output'])
+            self.file.truncate()
+
+    def print_config(self):
+        print(json.dumps(self.config()), file=self.file)
 
     def print_prologue(self, reason):
+        self.termination = reason
+
         print(f'TERMINATED: ' + reason, file=self.file) 
 
-        for state_type in self.automaton.States:
-            counts = [state.counts[state_type] for state in self.states]
-            max_count = max(counts)
-            min_count = min(counts)
-            print(f'{state_type.name} MAX_COUNT={max_count}', file=self.file)
-            print(f'{state_type.name} MIN_COUNT={min_count}', file=self.file)
-            print(f'{state_type.name} RANGE_COUNT={max_count - min_count}', file=self.file)
-
-            if len(counts) > 1:
-                sd_count = statistics.stdev(counts)
-                print(f'{state_type.name} STDEV_COUNT={sd_count}', file=self.file)
-
-                diffs = [counts[i + 1] - counts[i] for i in range(len(counts) - 1)]
-                max_diff = max(diffs)
-                min_diff = min(diffs)
-                print(f'{state_type.name} MAX_DIFF={max_diff}', file=self.file)
-                print(f'{state_type.name} MIN_DIFF={min_diff}', file=self.file)
-                print(f'{state_type.name} RANGE_DIFF={max_diff - min_diff}', file=self.file)
-
-                if len(diffs) > 1:
-                    sd_diff = statistics.stdev(diffs)
-                    print(f'{state_type.name} STDEV_DIFF={sd_diff}', file=self.file)
+        for name, value in self.stats().items():
+            print(f'{name}={value}', file=self.file)
+
+        if METRICS.enabled:
+            METRICS.peak('history_bytes', self.history.nbytes())
+        if self.metrics:
+            print(f'METRICS={json.dumps(METRICS.summary())}', file=self.file)
 
         print('### DONE ###', file=self.file)
 
-    def state_generator(self):
-        while True:
-            automaton_state = AutomatonState(self.automaton.states, self.automaton.States)
+    def print_generation(self, automaton_state):
+        print(f'{self.current_generation}: ' + automaton_state.summary(), file=self.file)
+
+    def symmetric_states(self, automaton_state):
+        """
+        Yields (kind, canonical) for each kind of SYMMETRIES the tiling has, where canonical is the AutomatonState of the
+        least, by packed bytes, of the images of automaton_state under the symmetries of that and all previous kinds.
+        Generations that are images of each other under those symmetries have the same canonical state.
+        """
+
+        symmetries = self.automaton.geometry.symmetries()
+        state = automaton_state.state
+        population = automaton_state.counts[self.automaton.States.ALIVE]
+
+        # the least image so far, starting with the identity
+        least = state[None, :]
+        for kind in self.SYMMETRIES:
+            if not len(symmetries[kind]):
+                continue
+
+            images = np.concatenate((least, state[symmetries[kind]]))
+            packed = np.packbits(images, axis=1)
+            least = images[[min(range(len(packed)), key=lambda i: packed[i].tobytes())]]
+
+            yield kind, AutomatonState(least[0], self.automaton.States, population=population)
+
+    def observe(self):
+        """
+        Records the current generation of the automaton.
+
+        Returns
+        -------
+        (automaton_state, reason): tuple of AutomatonState and str
+            reason is None unless the search terminates at this generation.
+        """
+
+        with METRICS.timer('state'):
+            automaton_state = AutomatonState(self.automaton.states, self.automaton.States, population=self.automaton.population)
+        if self.recorder is not None:
+            self.recorder.add(automaton_state.state)
+        if self.keep_states:
             self.states.append(automaton_state)
-            yield automaton_state
 
-            if automaton_state.all_equal():
-                self.print_prologue(f'ALL STATES EQUAL {automaton_state.state[0].name}')
-                break
+        for state_type, count in automaton_state.counts.items():
+            self.count_stats[state_type].push(count)
+            if self.previous_counts is not None:
+                self.diff_stats[state_type].push(count - self.previous_counts[state_type])
+        self.previous_counts = automaton_state.counts
+
+        if automaton_state.all_equal():
+            return automaton_state, f'ALL STATES EQUAL {automaton_state.first().name}'
+
+        with METRICS.timer('history'):
+            previous_gen = self.history.lookup(automaton_state)
+        if previous_gen:
+            self.period = self.current_generation - previous_gen
+            if previous_gen == self.current_generation - 1:
+                return automaton_state, f'STATIC. NO CHANGE FROM GENERATION {previous_gen}'
+            else:
+                return automaton_state, f'PERIODIC. REVISITED GENERATION {previous_gen}. PERIOD={self.current_generation - previous_gen}'
+
+        symmetric_states = []
+        if self.symmetry:
+            with METRICS.timer('symmetry'):
+                symmetric_states = list(self.symmetric_states(automaton_state))
+
+        for kind, symmetric_state in symmetric_states:
+            with METRICS.timer('history'):
+                previous_gen = self.symmetric_histories[kind].lookup(symmetric_state)
+            if previous_gen:
+                self.period = self.current_generation - previous_gen
+                return automaton_state, (f'PERIODIC MOD {kind}. REVISITED GENERATION {previous_gen} UP TO {kind}. '
+                                         f'PERIOD={self.period}')
+
+        population = automaton_state.counts[self.automaton.States.ALIVE]
+        changed = self.automaton.births + self.automaton.deaths
+        for detector in self.detectors:
+            if reason := detector.update(population, changed, automaton_state.size):
+                return automaton_state, reason
+
+        if self.current_generation >= self.max_steps:
+            return automaton_state, 'MAX STEPS REACHED'
+
+        self.history.add(automaton_state, self.current_generation)
+        for kind, symmetric_state in symmetric_states:
+            self.symmetric_histories[kind].add(symmetric_state, self.current_generation)
+
+        return automaton_state, None
 
-            if previous_gen := self.state_to_generation.get(automaton_state):
-                if previous_gen == self.current_generation - 1:
-                    self.print_prologue(f'STATIC. NO CHANGE FROM GENERATION {previous_gen}')
-                else:
-                    self.print_prologue(f'PERIODIC. REVISITED GENERATION {previous_gen}. PERIOD={self.current_generation - previous_gen}')
-                break
+    def state_generator(self):
+        while True:
+            automaton_state, reason = self.observe()
+            yield automaton_state
 
-            if self.current_generation >= self.max_steps:
-                self.print_prologue('MAX STEPS REACHED')
+            if reason is not None:
+                self.print_prologue(reason)
                 break
 
-            self.state_to_generation[automaton_state] = self.current_generation
-
             self.automaton.step()
             self.current_generation += 1
 
     def run(self, steps=None):
         for state in itertools.islice(self.state_generator(), steps):
-            print(f'{self.current_generation}: ' + state.summary(), file=self.file)
+            self.print_generation(state)
+
+class BatchSearch():
+    """
+    Runs a Search for each (rule, seed, file) in runs, all on one {p, q} tiling, stepping the universes together.
+    Universes leave the batch as soon as their search terminates.
+    """
+
+    def __init__(self, p, q, layers, runs, max_steps=None, init_prob=None, init_limit=None, cache=True, history='fingerprint',
+                 automaton=None, checkpoint=None, early_stop=None, symmetry=False):
+        # any automaton with this geometry can lend its tiling to the batch; it is not modified
+        if automaton is None:
+            automaton = HyperbolicAutomaton('b s', p, q, layers, cache=cache)
+        self.batch = BatchedAutomaton(automaton)
+        self.searches = {}
+
+        # Search.result() of every finished search, taken before its universe leaves the batch
+        self.results = {}
+
+        for rule, seed, file in runs:
+            # same initial state as a lone Search with this seed
+            states = random_states(self.batch.geometry, init_prob or 0, np.random.default_rng(seed), limit=init_limit)
+
+            uid = self.batch.add(rule, states)
+            self.searches[uid] = Search(rule, p, q, layers, seed, max_steps=max_steps, file=file, init_prob=init_prob,
+                                        init_limit=init_limit, history=history, automaton=self.batch.universe(uid),
+                                        early_stop=early_stop, symmetry=symmetry)
+
+        if checkpoint is not None:
+            self.restore(checkpoint)
+
+    def checkpoint(self):
+        return [search.checkpoint() for search in self.searches.values()]
+
+    def restore(self, checkpoint):
+        finished = []
+        for (uid, search), search_checkpoint in zip(self.searches.items(), checkpoint):
+            search.restore(search_checkpoint)
+            if search.termination is not None:
+                self.results[uid] = search.result()
+                finished.append(uid)
+
+        self.batch.remove(finished)
+
+    def print_config(self):
+        for search in self.searches.values():
+            search.print_config()
+
+    def run(self, on_checkpoint=None, checkpoint_interval=60):
+        """
+        Runs the searches until all of them terminate. If on_checkpoint is given, it is called with checkpoint()
+        at most every checkpoint_interval seconds.
+        """
+
+        running = {uid: search for uid, search in self.searches.items() if search.termination is None}
+        last_checkpoint = time.monotonic()
+
+        while running:
+            finished = []
+            for uid, search in running.items():
+                automaton_state, reason = search.observe()
+                search.print_generation(automaton_state)
+
+                if reason is not None:
+                    search.print_prologue(reason)
+                    self.results[uid] = search.result()
+                    finished.append(uid)
+
+            for uid in finished:
+                del running[uid]
+            self.batch.remove(finished)
+
+            if running:
+                self.batch.step()
+                for search in running.values():
+                    search.current_generation += 1
+
+                if on_checkpoint is not None and time.monotonic() - last_checkpoint >= checkpoint_interval:
+                    on_checkpoint(self.checkpoint())
+                    last_checkpoint = time.monotonic()
 
 def main():
     parser = argparse.ArgumentParser()
 
-    parser.add_argument('p', help='number of sides to a polygon', type=int)
-    parser.add_argument('q', help='number of polygons around a vertex', type=int)
-    parser.add_argument('rule', help='format: b[0-9 ]+s[0-9 ]+', type=str)
-    parser.add_argument('-l', '--layers', help='number of layers to initially generate. default: 5', type=int, required=False, default=5)
+    parser.add_argument('p', help='number of sides to a polygon. taken from the snapshot with --load', type=int, nargs='?')
+    parser.add_argument('q', help='number of polygons around a vertex. taken from the snapshot with --load', type=int, nargs='?')
+    parser.add_argument('rule', help='format: b[0-9 ]+s[0-9 ]+. replaces the rule of the snapshot with --load', type=str, nargs='?')
+    parser.add_argument('-l', '--layers', help='number of layers to initially generate. default: 5', type=int, required=False)
     parser.add_argument('-s', '--seed', type=int)
     parser.add_argument('-p', '--init-prob', help='probability of making a cell alive during random automaton initialization. default: 0.5',
-                        type=float, default=0.5)
+                        type=float)
     parser.add_argument('-n', '--init-limit', help='limit number of cells to randomize at initialization', type=int)
+    parser.add_argument('--init-layers', help='only randomize cells in this many innermost layers at initialization', type=int)
+    parser.add_argument('--init-radius', help='only randomize cells within this hyperbolic distance of the center at initialization',
+                        type=float)
+    parser.add_argument('-b', '--backend', help='step engine. default: auto (chosen by cell count)', choices=('auto', *BACKENDS), default='auto')
+    parser.add_argument('-i', '--incremental', help='only re-evaluate cells near the ones that changed in the last generation', action='store_true')
+    parser.add_argument('--no-cache', help='always build the tiling instead of using the tiling cache', dest='cache', action='store_false')
+    parser.add_argument('-x', '--auto-expand', help='grow the tiling when alive cells near its boundary and trim dead outer layers',
+                        action='store_true')
+    parser.add_argument('--max-layers', help='number of layers the tiling may grow to with --auto-expand. default: 7, or -l if greater', type=int)
     parser.add_argument('-m', '--max-steps', type=int)
+    parser.add_argument('--history', help='how generations are remembered for cycle detection. fingerprint matches cycles longer than 64 generations by a 128-bit hash alone. bounded may find them late, or not within the max steps. default: fingerprint', choices=HISTORIES, default='fingerprint')
+    parser.add_argument('-e', '--early-stop', help='stop once the population looks uninteresting. format: name[:option=value,...], '
+                        f'name one of {", ".join(DETECTORS)}. may be given several times', action='append', metavar='DETECTOR')
+    parser.add_argument('--symmetry', help='also stop once a generation is a rotated or reflected copy of an earlier one', action='store_true')
+    parser.add_argument('--load', help='continue from a snapshot written by the shell\'s save command', type=Path, metavar='SNAPSHOT')
     parser.add_argument('-o', '--outfile', type=Path)
+    parser.add_argument('--metrics', help='time the hot paths and print the measurements as a METRICS= line of JSON before ### DONE ###',
+                        action='store_true')
+    parser.add_argument('--record', help='render the generations to an animated .gif, .webp or .png (APNG) file, or to a directory of PNGs. '
+                        'animated files keep every frame in memory until the end, so prefer a directory for long runs',
+                        type=Path, metavar='PATH')
+    parser.add_argument('--record-size', help='width and height of the recorded frames in pixels. default: 512', type=int, default=512)
+    parser.add_argument('--record-every', help='record every nth generation. default: 1', type=int, default=1, metavar='N')
+    parser.add_argument('--fps', help='frame rate of recorded animations. default: 10', type=float, default=10)
 
     args = parser.parse_args()
 
-    if args.layers < 1:
+    if args.p is not None and args.q is None:
+        raise RuntimeError('p and q must be given together')
+
+    # a loaded snapshot brings its own cells and tiling, so nothing is generated or randomized
+    if args.load is not None:
+        given = [option for option, value in (('-l', args.layers), ('--seed', args.seed), ('--init-prob', args.init_prob),
+                                              ('--init-limit', args.init_limit), ('--init-layers', args.init_layers),
+                                              ('--init-radius', args.init_radius)) if value is not None]
+        if given:
+            raise RuntimeError(f'--load cannot be used with {", ".join(given)}')
+    elif args.rule is None:
+        raise RuntimeError('p, q and rule are required without --load')
+    else:
+        if args.layers is None:
+            args.layers = 5
+        if args.init_prob is None:
+            args.init_prob = 0.5
+
+    if args.seed is not None and args.seed < 0:
+        raise RuntimeError('seed must not be negative')
+
+    if args.layers is not None and args.layers < 1:
         raise RuntimeError('number of layers must be greater than 0')
 
-    random.seed(args.seed)
+    if args.max_layers is not None and not args.auto_expand:
+        raise RuntimeError('--max-layers must be used with --auto-expand')
+
+    if args.metrics:
+        METRICS.enable()
 
     if args.outfile:
         fp = args.outfile.open('w')
@@ -172,12 +849,31 @@ def main():
         max_steps=args.max_steps,
         file=fp,
         init_prob=args.init_prob,
-        init_limit=args.init_limit
+        init_limit=args.init_limit,
+        backend=args.backend,
+        incremental=args.incremental,
+        cache=args.cache,
+        history=args.history,
+        early_stop=args.early_stop,
+        auto_expand=args.auto_expand,
+        max_layers=args.max_layers,
+        metrics=args.metrics,
+        symmetry=args.symmetry,
+        snapshot=args.load,
+        init_layers=args.init_layers,
+        init_radius=args.init_radius
     )
 
+    if args.record:
+        renderer = Renderer(search.automaton.geometry, size=args.record_size)
+        search.recorder = Recorder(renderer, args.record, fps=args.fps, every=args.record_every)
+
     search.print_config()
     search.run()
 
+    if search.recorder is not None:
+        search.recorder.close()
+
     if args.outfile:
         fp.close()
         
@@ -4,12 +4,27 @@ import random
 import signal
 import sys
 import os
+import io
 import argparse
+import itertools
+import contextlib
+import functools
+import multiprocessing
+import queue
+import traceback
+import json
 
 from pathlib import Path
 from types import SimpleNamespace
 
-from search import Search
+import numpy as np
+
+from search import BatchSearch, HISTORIES, DETECTORS, parse_detector
+from results import ResultStore
+from campaign import Campaign
+from hypergol.automaton import HyperbolicAutomaton
+from hypergol.tiling import load_geometry
+from hypergol.metrics import METRICS, Metrics
 
 GEOMETRIES = (
     (3, 7),
@@ -41,46 +56,251 @@ def random_rule(max_neighbors):
         ' '.join(map(str, sorted(survive))),
     ))
 
-def run_search(root_path, config):
-    rule, p, q, layers, seed, init_prob, init_limit = config
+class WarmAutomata():
+    """
+    One automaton per geometry, whose tiling is shared by all batches run by a worker. Geometries come from the main
+    process where possible, so that workers only allocate their own states.
+    """
+
+    def __init__(self, cache=True, geometries=None):
+        self.cache = cache
+        self.geometries = geometries or {}
+        self.automata = {}
+
+    def get(self, configs):
+        """
+        Returns the automaton for the geometry of the batch configs.
+        """
+
+        _, p, q, layers, _, _, _ = configs[0]
+
+        if (p, q, layers) not in self.automata:
+            self.automata[p, q, layers] = HyperbolicAutomaton('b s', p, q, layers, cache=self.cache,
+                                                              geometry=self.geometries.get((p, q, layers)))
+
+        return self.automata[p, q, layers]
+
+def run_search(root_path, configs, cache=True, history='fingerprint', automaton=None, store=None, trace=False,
+               checkpoint=None, on_checkpoint=None, checkpoint_interval=60, early_stop=None, symmetry=False):
+    # every config of a batch shares its geometry and initialization parameters
+    _, p, q, layers, _, init_prob, init_limit = configs[0]
+
+    with contextlib.ExitStack() as stack:
+        runs = []
+        for rule, _, _, _, seed, _, _ in configs:
+            if store is None:
+                outfile = Path(root_path, f'{p}_{q}', rule.replace(' ', '_'), str(seed))
+
+                print(outfile)
+
+                outfile.parent.mkdir(parents=True, exist_ok=True)
+                # a resumed search continues the output it wrote before its checkpoint
+                file = stack.enter_context(outfile.open('w' if checkpoint is None else 'r+'))
+            elif trace:
+                file = io.StringIO()
+            else:
+                file = stack.enter_context(open(os.devnull, 'w'))
+
+            runs.append((rule, seed, file))
+
+        search = BatchSearch(p, q, layers, runs, init_prob=init_prob, init_limit=init_limit, cache=cache, history=history,
+                             automaton=automaton, checkpoint=checkpoint, early_stop=early_stop, symmetry=symmetry)
+        if checkpoint is None:
+            search.print_config()
+        search.run(on_checkpoint=on_checkpoint, checkpoint_interval=checkpoint_interval)
+
+        if store is not None:
+            results = [search.results[uid] for uid in search.searches]
+            traces = [run.file.getvalue() for run in search.searches.values()] if trace else None
+
+            # one transaction per batch. a batch stored before a crash kept it from being marked done is ignored
+            # when it is stored again
+            store.add(results, traces)
 
-    outfile = Path(root_path, f'{p}_{q}', rule.replace(' ', '_'), str(seed))
+            for result in results:
+                print(f"{p}_{q} {result['config']['rule']} {result['config']['seed']}: {result['termination']}")
 
-    print(outfile)
+def worker(jobs, root_path, cache, history, database=None, trace=False, manifest=None, checkpoint_interval=60,
+           early_stop=None, metrics=None, geometries=None, symmetry=False):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
 
-    outfile.parent.mkdir(parents=True, exist_ok=True)
+    # sqlite connections must not cross a fork, so each worker opens its own
+    store = None if database is None else ResultStore(database)
+    campaign = None if manifest is None else Campaign(manifest)
 
-    with outfile.open('w') as fp:
-        search = Search(rule, p, q, layers, seed, file=fp, init_prob=init_prob, init_limit=init_limit)
-        search.print_config()
-        search.run()
+    automata = WarmAutomata(cache, geometries)
+
+    for batch_id, configs in iter(jobs.get, None):
+        checkpoint = None
+        on_checkpoint = None
+        if campaign is not None:
+            checkpoint = campaign.start(batch_id)
+            on_checkpoint = functools.partial(campaign.checkpoint, batch_id)
+
+        try:
+            run_search(root_path, configs, cache=cache, history=history, automaton=automata.get(configs), store=store,
+                       trace=trace, checkpoint=checkpoint, on_checkpoint=on_checkpoint,
+                       checkpoint_interval=checkpoint_interval, early_stop=early_stop, symmetry=symmetry)
+        except Exception:
+            traceback.print_exc()
+            if campaign is not None:
+                campaign.fail(batch_id)
+            continue
+
+        # a crash between storing the results and this leaves the batch to be run again on resume
+        if campaign is not None:
+            campaign.finish(batch_id)
+
+    if store is not None:
+        store.close()
+    if campaign is not None:
+        campaign.close()
+
+    # the metrics of this worker, to be aggregated by the main process
+    if metrics is not None:
+        metrics.put(METRICS)
+
+def config_generator(layers, init_prob, init_limit, batch, tried=None, seeds=None):
+    """
+    Yields batches of configs. If tried is given, rules for which tried(p, q, layers, rule) is true are drawn again.
+    The seed of every run is drawn from its own child of the SeedSequence seeds, a fresh one by default.
+    """
+
+    if seeds is None:
+        seeds = np.random.SeedSequence()
 
-def config_generator(layers, init_prob, init_limit):
     while RUNNING:
         geometry = random.choice(GEOMETRIES)
         p, q = geometry
         max_neighbors = p * (q - 2)
-        rule = random_rule(max_neighbors)
 
-        for _ in range(3):
-            if not RUNNING:
-                break
-            seed = random.randrange(2 ** 64)
-            yield (rule, p, q, layers, seed, init_prob, init_limit)
+        configs = []
+        rules = set()
+        for _ in range(batch):
+            rule = random_rule(max_neighbors)
+
+            if tried is not None:
+                while rule in rules or tried(p, q, layers, rule):
+                    rule = random_rule(max_neighbors)
+                rules.add(rule)
+
+            # independent streams for parallel runs, each reproducible from the 64-bit seed stored with its results
+            for child in seeds.spawn(3):
+                seed = int(child.generate_state(1, np.uint64)[0])
+                configs.append((rule, p, q, layers, seed, init_prob, init_limit))
+
+        yield configs
+
+def campaign_batches(campaign, layers, init_prob, init_limit, batch, seeds=None):
+    """
+    Yields (id, configs) for the unfinished batches of campaign, then for new batches, which are recorded in it.
+    A resumed campaign continues with its own seeds.
+    """
+
+    yield from campaign.unfinished()
+
+    if (state := campaign.random_state()) is not None:
+        random_state, seeds = state
+        random.setstate(random_state)
+    elif seeds is None:
+        seeds = np.random.SeedSequence()
+
+    for configs in config_generator(layers, init_prob, init_limit, batch, tried=campaign.tried, seeds=seeds):
+        yield campaign.add(configs, (random.getstate(), seeds)), configs
+
+def add_search_arguments(parser):
+    """
+    Adds the options that choose and run the configs, shared with coordinator.py.
+    """
 
-def main():
-    parser = argparse.ArgumentParser()
-    parser.add_argument('-j', '--jobs', help='default: 1', type=int, default=1)
     parser.add_argument('-l', '--layers', help='number of layers to initially generate. default: 5', type=int, required=False, default=5)
+    parser.add_argument('-s', '--seed', help='seed of the random configs. ignored when resuming a campaign', type=int)
     parser.add_argument('-p', '--init-prob', help='probability of making a cell alive during random automaton initialization. default: 0.5',
                         type=float, default=0.5)
     parser.add_argument('-n', '--init-limit', help='limit number of cells to randomize at initialization', type=int)
+    parser.add_argument('-B', '--batch', help='number of rules to simulate together on one tiling, 3 seeds each. default: 1', type=int, default=1)
+    parser.add_argument('--history', help='how generations are remembered for cycle detection. fingerprint matches cycles longer than 64 '
+                        'generations by a 128-bit hash alone. bounded may find them late, or not within the max steps. default: fingerprint',
+                        choices=HISTORIES, default='fingerprint')
+    parser.add_argument('-e', '--early-stop', help='stop runs once their population looks uninteresting. format: name[:option=value,...], '
+                        f'name one of {", ".join(DETECTORS)}. may be given several times', action='append', metavar='DETECTOR')
+    parser.add_argument('--symmetry', help='also stop runs once a generation is a rotated or reflected copy of an earlier one',
+                        action='store_true')
+
+def check_search_arguments(args):
+    """
+    Validates the options added by add_search_arguments and --trace, seeds the rule draws and returns the SeedSequence
+    of the runs.
+    """
+
+    if args.seed is not None and args.seed < 0:
+        raise RuntimeError('seed must not be negative')
+
+    if args.trace and args.database is None:
+        raise RuntimeError('--trace requires --database')
+
+    # fail on invalid detectors here rather than in every worker
+    for spec in args.early_stop or ():
+        parse_detector(spec)
+
+    random.seed(args.seed)
+    return np.random.SeedSequence(args.seed)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-j', '--jobs', help='default: 1', type=int, default=1)
+    add_search_arguments(parser)
     parser.add_argument('-r', '--root', help='root directory to save all outfiles', type=Path, default=Path.cwd())
+    parser.add_argument('--no-cache', help='always build the tiling instead of using the tiling cache', dest='cache', action='store_false')
+    parser.add_argument('-d', '--database', help='store results in this SQLite database instead of one outfile per run (see results.py)', type=Path)
+    parser.add_argument('--trace', help='with --database, also store the compressed output of every run', action='store_true')
+    parser.add_argument('-c', '--campaign', help='manifest of the campaign, which is resumed if it exists. '
+                        'tried rules are never drawn again and running batches are checkpointed', type=Path)
+    parser.add_argument('--checkpoint-interval', help='seconds between checkpoints of running batches of a campaign. default: 60',
+                        type=float, default=60)
+    parser.add_argument('--metrics', help='time the hot paths of all workers and print the totals as a METRICS= line of JSON at the end',
+                        action='store_true')
 
     args = parser.parse_args()
 
-    children = set()
-    max_children = args.jobs
+    seeds = check_search_arguments(args)
+
+    if args.database is not None:
+        # creates the schema once, before the workers race to do so
+        ResultStore(args.database).close()
+
+    campaign = None
+    if args.campaign is not None:
+        campaign = Campaign(args.campaign)
+        if counts := campaign.counts():
+            print(f'Resuming campaign: {counts.get(Campaign.DONE, 0)} batches done, '
+                  f'{counts.get(Campaign.PENDING, 0) + counts.get(Campaign.RUNNING, 0) + counts.get(Campaign.FAILED, 0)} to go')
+
+    context = multiprocessing.get_context('fork')
+
+    # holding at most one batch per worker, so configs are drawn just before they can run
+    jobs = context.Queue(maxsize=args.jobs)
+
+    # workers inherit the enabled metrics and send theirs back when they exit
+    metrics = None
+    if args.metrics:
+        METRICS.enable()
+        metrics = context.Queue()
+
+    # loaded once, before forking: cached geometries are memory mapped and built ones inherited copy-on-write, so every
+    # worker reads the same physical pages. workers never move their tilings, which would write to them
+    geometries = {(p, q, args.layers): load_geometry(p, q, args.layers, cache=args.cache) for p, q in GEOMETRIES}
+
+    def start_worker():
+        process = context.Process(target=worker, args=(jobs, args.root, args.cache, args.history, args.database, args.trace,
+                                                       args.campaign, args.checkpoint_interval, args.early_stop, metrics,
+                                                       geometries, args.symmetry),
+                                  daemon=True)
+        process.start()
+        return process
+
+    workers = [start_worker() for _ in range(args.jobs)]
 
     def graceful_shutdown(signum, frame):
         global RUNNING
@@ -88,41 +308,55 @@ def main():
             RUNNING = False
             os.write(sys.stdout.fileno(), b'Stopping after current jobs finish. Press Ctrl + C again to force quit.')
         else:
-            for child in children:
-                os.kill(child, signal.SIGKILL)
+            for process in workers:
+                process.kill()
             sys.exit(0)
 
     signal.signal(signal.SIGINT, graceful_shutdown)
     signal.signal(signal.SIGTERM, graceful_shutdown)
 
-    for config in config_generator(args.layers, args.init_prob, args.init_limit):
-        if len(children) == max_children:
-            while True:
-                if not RUNNING:
-                    break
+    if campaign is None:
+        batches = zip(itertools.repeat(None), config_generator(args.layers, args.init_prob, args.init_limit, args.batch, seeds=seeds))
+    else:
+        batches = campaign_batches(campaign, args.layers, args.init_prob, args.init_limit, args.batch, seeds=seeds)
 
-                pid, status = os.waitpid(0, os.WNOHANG)
-                if (pid, status) != (0, 0):
-                    break
+    for job in batches:
+        if not RUNNING:
+            break
 
-            if not RUNNING:
+        while RUNNING:
+            try:
+                jobs.put(job, timeout=1)
                 break
+            except queue.Full:
+                # replace workers that died, so the queue keeps draining
+                workers = [process if process.is_alive() else start_worker() for process in workers]
 
-            children.remove(pid)
+    # drop batches nobody has started yet, then tell every worker to exit
+    try:
+        while True:
+            jobs.get_nowait()
+    except queue.Empty:
+        pass
 
-        if RUNNING and len(children) < max_children:
-            pid = os.fork()
-            if pid == 0:
-                # child process
-                signal.signal(signal.SIGINT, signal.SIG_IGN)
-                signal.signal(signal.SIGTERM, signal.SIG_IGN)
-                run_search(args.root, config)
-                sys.exit(0)
-            else:
-                children.add(pid)
+    for _ in workers:
+        jobs.put(None)
+
+    if metrics is not None:
+        # a worker only exits once its metrics left the queue's buffer, so they are read before joining
+        total = Metrics()
+        for _ in workers:
+            while True:
+                try:
+                    total.merge(metrics.get(timeout=1))
+                    break
+                except queue.Empty:
+                    if not any(process.is_alive() for process in workers) and metrics.empty():
+                        break
+        print(f'METRICS={json.dumps(total.summary())}')
 
-    for child in children:
-        os.waitpid(child, 0)
+    for process in workers:
+        process.join()
 
 if __name__ == '__main__':
     main()